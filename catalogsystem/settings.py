@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 import os
 import sys
 
+from datetime import timedelta
 from pathlib import Path
 
 import django_heroku
@@ -60,6 +61,7 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
+    'products.middleware.LoadSheddingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -101,6 +103,19 @@ DATABASES = {
     }
 }
 
+# Product shards: comma separated database aliases holding products (see
+# products/sharding.py). Empty: all products in the default database.
+# Aliases not defined in DATABASES use a local SQLite database.
+PRODUCT_SHARDS = [alias for alias in get_env('PRODUCT_SHARDS', '').split(',') if alias]
+
+for alias in PRODUCT_SHARDS:
+    DATABASES.setdefault(alias, {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / f'db_{alias}.sqlite3',
+    })
+
+DATABASE_ROUTERS = ['products.sharding.ShardRouter']
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -167,13 +182,57 @@ REST_FRAMEWORK = {
         'rest_framework.authentication.SessionAuthentication',
     ),
     'DEFAULT_RENDERER_CLASSES': DEFAULT_RENDERER_CLASSES,
+    'DEFAULT_THROTTLE_RATES': { # Anonymous users (see products/throttling.py)
+        'anon-product-list': '10/min', # Whole catalog
+        'anon-product-retrieve': '120/min',
+    },
+    # Proxies in front of the app (Heroku router): the client IP used by
+    # throttles is the last X-Forwarded-For address, the one the router appended
+    'NUM_PROXIES': 1,
 }
 
+# Throttling
+THROTTLE_CACHE = None # Cache alias to share buckets between workers (None: per worker)
+THROTTLE_MAX_BUCKETS = 100000 # Buckets (clients) kept per worker
+
+# Concurrent updates (see products/views.py)
+# Updates and deletions without If-Match header get 428 (0 to allow them, e.g.
+# for the browsable API forms, checking the version read by the request only)
+REQUIRE_IF_MATCH = bool(int(get_env('REQUIRE_IF_MATCH', '1')))
+
+# Load shedding (see products/middleware.py)
+LOAD_SHEDDING_MAX_QUEUE_DELAY = 1 # Seconds
+LOAD_SHEDDING_EXEMPT_URLS = ['rest_framework:login', 'admin:login'] # URL names never shed
+LOAD_SHEDDING_LOGIN_COOKIE = 'logged_in' # Signed cookie set at login (see has_session)
+
 # Login
 LOGIN_URL = 'rest_framework:login'
 LOGIN_REDIRECT_URL = 'api-root'
 LOGOUT_REDIRECT_URL = LOGIN_URL
 
+# Visits analytics
+VISITS_FLUSH_INTERVAL = 10 # Seconds between writes of buffered visits
+VISITS_FLUSH_MAX_KEYS = 1000 # Buffered (product, minute) buckets forcing a write
+VISITS_RETENTION = { # Age of buckets before compaction (or removal, for days)
+    'minute': timedelta(hours=2),
+    'hour': timedelta(days=7),
+    'day': timedelta(days=365),
+}
+
+# Coalescing of concurrent anonymous product reads (see products/coalescing.py)
+# Cache alias shared by the workers of a host (e.g. a file based cache), to
+# coalesce reads across workers. None: reads are coalesced within each worker.
+COALESCING_CACHE = None
+COALESCING_LOCK_TIMEOUT = 2 # Seconds a worker waits for another worker's read
+COALESCING_RESULT_TIMEOUT = 1 # Seconds a read is shared through the cache
+
+# In-memory catalog snapshot, per worker, for anonymous reads (see products/replica.py)
+CATALOG_SNAPSHOT = bool(int(get_env('CATALOG_SNAPSHOT', '0')))
+CATALOG_SNAPSHOT_REFRESH_INTERVAL = 5 # Seconds between checks of catalog changes
+CATALOG_SNAPSHOT_MAX_CHANGES = 1000 # Pending changes forcing a full reload
+CATALOG_SNAPSHOT_GAP_TIMEOUT = 60 # Seconds a skipped change ID is waited for (uncommitted write)
+CATALOG_CHANGES_RETENTION = timedelta(days=1) # See prune_catalog_changes command
+
 # Email
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST = get_env('EMAIL_HOST')
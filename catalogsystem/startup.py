@@ -0,0 +1,94 @@
+"""
+Startup instrumentation for catalogsystem project.
+
+Records how long startup steps take (``timed``) and, when the STARTUP_PROFILE
+environment variable is set to 1, how long importing each module takes
+(``profile_imports``). ``report`` prints the results to stderr, so they end up
+in the server log.
+
+This module is imported before Django, so it only uses the standard library.
+"""
+import importlib.abc
+import os
+import sys
+import time
+
+from contextlib import contextmanager
+
+# Startup steps: list of (name, seconds)
+steps = []
+# Imported modules: {name: [cumulative seconds, self seconds]}
+imports = {}
+
+def is_profiling():
+    """ Returns whether module imports are profiled """
+    return os.environ.get('STARTUP_PROFILE') == '1'
+
+@contextmanager
+def timed(name):
+    """ Records the duration of a startup step """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        steps.append((name, time.perf_counter() - start))
+
+class _TimedLoader(importlib.abc.Loader):
+    """ Wraps a module loader to time module execution """
+
+    def __init__(self, loader, finder):
+        self.loader = loader
+        self.finder = finder
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        self.finder.stack.append(0.0) # Time spent importing submodules
+        start = time.perf_counter()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            elapsed = time.perf_counter() - start
+            children = self.finder.stack.pop()
+            if self.finder.stack:
+                self.finder.stack[-1] += elapsed
+            imports[module.__name__] = [elapsed, elapsed - children]
+
+    def __getattr__(self, name): # Other loader methods (e.g. get_resource_reader)
+        return getattr(self.loader, name)
+
+class _ImportTimer(importlib.abc.MetaPathFinder):
+    """ Meta path finder timing the modules found by the other finders """
+
+    def __init__(self):
+        self.stack = []
+
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = _TimedLoader(spec.loader, self)
+                return spec
+        return None
+
+def profile_imports():
+    """ Starts timing module imports, if STARTUP_PROFILE is set """
+    if is_profiling() and not any(isinstance(finder, _ImportTimer) for finder in sys.meta_path):
+        sys.meta_path.insert(0, _ImportTimer())
+
+def report(limit=25):
+    """ Prints startup steps durations and, if profiled, the slowest imports """
+    total = sum(elapsed for _, elapsed in steps)
+    print(f"Startup ({os.getpid()}): {total:.3f} s", file=sys.stderr)
+    for name, elapsed in steps:
+        print(f"\t{name}: {elapsed:.3f} s", file=sys.stderr)
+    if not imports:
+        return
+    print(f"Slowest imports (cumulative / self, {len(imports)} modules):", file=sys.stderr)
+    slowest = sorted(imports.items(), key=lambda item: item[1][0], reverse=True)[:limit]
+    for name, (cumulative, own) in slowest:
+        print(f"\t{name}: {cumulative:.3f} s / {own:.3f} s", file=sys.stderr)
@@ -3,14 +3,28 @@ WSGI config for catalogsystem project.
 
 It exposes the WSGI callable as a module-level variable named ``application``.
 
+Loading this module also warms the application up (see products/warmup.py)
+and reports startup costs (see startup.py).
+
 For more information on this file, see
 https://docs.djangoproject.com/en/3.2/howto/deployment/wsgi/
 """
 
 import os
 
-from django.core.wsgi import get_wsgi_application
+from catalogsystem import startup
+
+startup.profile_imports()
+
+with startup.timed('django import'):
+    from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'catalogsystem.settings')
 
-application = get_wsgi_application()
+with startup.timed('django setup (settings, apps)'):
+    application = get_wsgi_application()
+
+from products.warmup import warm_up # Needs apps ready
+
+warm_up()
+startup.report()
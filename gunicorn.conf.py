@@ -0,0 +1,20 @@
+"""
+Gunicorn configuration for catalogsystem project.
+
+The application is loaded (and warmed up, see catalogsystem/wsgi.py) once in
+the master process, before forking workers, so new workers start with
+modules imported, URL tables built and caches primed.
+
+For more information on this file, see
+https://docs.gunicorn.org/en/stable/settings.html
+"""
+
+preload_app = True
+
+# Threaded workers, so concurrent requests of a worker share its in-process
+# caches (e.g. coalesced product reads, see products/coalescing.py)
+worker_class = 'gthread'
+threads = 4
+
+# Database connections are not opened in advance: Django connections are per
+# thread, so each request thread opens its own on its first request.
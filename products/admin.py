@@ -1,17 +1,146 @@
 from django.contrib import admin
-from .models import Brand, Product, User
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+from .models import Brand, Product, ProductLocation, User
+from .sharding import get_shards, is_sharded, shard_for_brand
+
+# Unfiltered tables with more (estimated) rows than this are not counted exactly
+ESTIMATED_COUNT_THRESHOLD = 100000
+
+class EstimatedCountPaginator(Paginator):
+    """ Paginator for big tables.
+        On PostgreSQL, unfiltered changelists use the planner's row estimate
+        instead of running an exact COUNT(*) over the whole table. Filtered
+        querysets (and other databases) fall back to the exact count. """
+
+    @cached_property
+    def count(self):
+        """ Returns the (estimated) total number of objects """
+        query = getattr(self.object_list, 'query', None)
+        if query is not None and not query.where:
+            connection = connections[self.object_list.db]
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        "SELECT reltuples FROM pg_class WHERE relname = %s",
+                        [self.object_list.model._meta.db_table]
+                    )
+                    row = cursor.fetchone()
+                if row and int(row[0]) > ESTIMATED_COUNT_THRESHOLD:
+                    return int(row[0])
+        return super(EstimatedCountPaginator, self).count
+
+class BaseAdmin(admin.ModelAdmin):
+    """ Base admin for big tables.
+        Avoids exact counts on every changelist view. """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False # Prevents a second COUNT(*) on filtered views
+
+class ShardListFilter(admin.SimpleListFilter):
+    """ Products shard filter.
+        When products are sharded, the changelist shows the products of one
+        shard at a time: the shard of the filtered brand, if any, otherwise
+        the selected one (the first one by default). """
+    title = "shard"
+    parameter_name = 'shard'
+
+    def lookups(self, request, model_admin):
+        return [(alias, alias) for alias in get_shards()]
+
+    def get_shard(self, params):
+        """ Returns database alias of the listed products, given the
+            changelist query parameters """
+        try:
+            return shard_for_brand(int(params['brand__id__exact']))
+        except (KeyError, ValueError): # No (valid) brand filter
+            pass
+        if self.value() in get_shards():
+            return self.value()
+        return get_shards()[0]
+
+    def choices(self, changelist):
+        shard = self.get_shard(changelist.params)
+        for alias, title in self.lookup_choices: # No "All" choice
+            yield {
+                'selected': alias == shard,
+                'query_string': changelist.get_query_string({self.parameter_name: alias}),
+                'display': title,
+            }
+
+    def queryset(self, request, queryset):
+        return queryset.using(self.get_shard(request.GET))
 
 @admin.register(User)
-class UserAdmin(admin.ModelAdmin):
-    """ Brands admin """
+class UserAdmin(BaseAdmin):
+    """ Users admin """
     list_display = ('id', 'username', 'first_name', 'last_name', 'email')
+    list_filter = ('is_staff', 'is_active')
+    search_fields = ('username__exact', 'email__exact') # Unique (indexed) fields
 
 @admin.register(Brand)
-class BrandAdmin(admin.ModelAdmin):
+class BrandAdmin(BaseAdmin):
     """ Brands admin """
     list_display = ('id', 'name')
+    search_fields = ('name__startswith', ) # Required by products brand autocomplete
+    ordering = ('name', )
+
+    def get_actions(self, request):
+        """ Bulk deletion doesn't delete products of other databases when
+            products are sharded (brands are deleted one by one instead) """
+        actions = super(BrandAdmin, self).get_actions(request)
+        if is_sharded():
+            actions.pop('delete_selected', None)
+        return actions
 
 @admin.register(Product)
-class ProductAdmin(admin.ModelAdmin):
+class ProductAdmin(BaseAdmin):
     """ Products admin """
-    list_display = ('id', 'sku', 'name', 'price', 'brand', 'visits')
\ No newline at end of file
+    list_display = ('id', 'sku', 'name', 'price', 'brand', 'visits')
+    list_select_related = ('brand', )
+    list_filter = ('brand', )
+    search_fields = ('sku__exact', 'name__startswith') # Indexed lookups
+    autocomplete_fields = ('brand', )
+
+    def get_queryset(self, request):
+        """ Gets products queryset. When products are sharded, brands are not
+            in the products database, so they are prefetched instead of joined. """
+        queryset = super(ProductAdmin, self).get_queryset(request)
+        if is_sharded():
+            queryset = queryset.prefetch_related('brand')
+        return queryset
+
+    def get_list_select_related(self, request):
+        """ Joins brands, unless products are sharded (see get_queryset) """
+        if is_sharded():
+            return ()
+        return self.list_select_related
+
+    def get_list_filter(self, request):
+        """ Adds the shard filter when products are sharded """
+        if is_sharded():
+            return self.list_filter + (ShardListFilter, )
+        return self.list_filter
+
+    def get_actions(self, request):
+        """ Bulk deletion doesn't delete product data of other databases when
+            products are sharded (products are deleted one by one instead) """
+        actions = super(ProductAdmin, self).get_actions(request)
+        if is_sharded():
+            actions.pop('delete_selected', None)
+        return actions
+
+    def get_object(self, request, object_id, from_field=None):
+        """ Gets product, from its shard when products are sharded """
+        if not is_sharded():
+            return super(ProductAdmin, self).get_object(request, object_id, from_field)
+        try:
+            shard = ProductLocation.get_shard(int(object_id))
+        except ValueError:
+            return None
+        try:
+            return self.get_queryset(request).using(shard).get(pk=object_id)
+        except (Product.DoesNotExist, ValidationError):
+            return None
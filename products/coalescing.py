@@ -0,0 +1,105 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+class _Call:
+    """ Call in progress, shared by concurrent callers with the same key """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """ Coalesces concurrent identical calls.
+        Concurrent calls with the same key, within a worker (threads, see
+        gunicorn.conf.py), run the function only once and share its result
+        (or exception). When
+        COALESCING_CACHE is set, workers also share results through that
+        cache: a worker computing a key holds a lock in it, and other workers
+        wait for the stored result instead of computing it again. """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.requests = 0
+        self.executions = 0
+
+    def do(self, key, function):
+        """ Returns function() result, shared with concurrent calls with the same key """
+        with self._lock:
+            self.requests += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = self._do_shared(key, function)
+        except Exception as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def _execute(self, function):
+        with self._lock:
+            self.executions += 1
+        return function()
+
+    def _do_shared(self, key, function):
+        """ Runs function once across workers sharing COALESCING_CACHE """
+        if not settings.COALESCING_CACHE:
+            return self._execute(function)
+        cache = caches[settings.COALESCING_CACHE]
+        result_key = f"{self.name}:result:{key}"
+        lock_key = f"{self.name}:lock:{key}"
+        result = cache.get(result_key)
+        if result is not None:
+            return result
+        if cache.add(lock_key, True, timeout=settings.COALESCING_LOCK_TIMEOUT):
+            try:
+                result = self._execute(function)
+                cache.set(result_key, result, timeout=settings.COALESCING_RESULT_TIMEOUT)
+            finally:
+                cache.delete(lock_key)
+            return result
+        # Another worker is computing it. It stores the result before releasing
+        # the lock, so a released lock without result means it failed (e.g. the
+        # product doesn't exist): the call is repeated here, raising the same error.
+        deadline = time.monotonic() + settings.COALESCING_LOCK_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(0.005)
+            result = cache.get(result_key)
+            if result is not None:
+                return result
+            if cache.get(lock_key) is None:
+                result = cache.get(result_key) # Stored just before releasing the lock
+                if result is not None:
+                    return result
+                break
+        return self._execute(function) # Other worker failed or is too slow
+
+    def get_stats(self):
+        """ Returns calls statistics of this worker """
+        with self._lock:
+            requests, executions = self.requests, self.executions
+        return {
+            'requests': requests,
+            'executions': executions,
+            'coalesced': requests - executions,
+            'coalescing_ratio': (requests - executions) / requests if requests else 0.0,
+        }
+
+# Anonymous product reads (see ProductViewSet.retrieve)
+product_reads = SingleFlight('product-reads')
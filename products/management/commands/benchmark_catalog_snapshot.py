@@ -0,0 +1,71 @@
+import time
+import tracemalloc
+
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from products.models import Brand, Product
+from products.replica import CatalogSnapshot
+
+class Command(BaseCommand):
+    """ Measures catalog snapshot memory footprint and lookup times, with
+        synthetic products (the database is not used). """
+    help = "Benchmarks the in-memory catalog snapshot"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=1000000)
+        parser.add_argument('--brands', type=int, default=1000)
+        parser.add_argument('--lookups', type=int, default=100000)
+
+    def rows(self, products, brands):
+        """ Generates synthetic product rows, sorted by ID """
+        for product_id in range(1, products + 1):
+            yield (product_id, f"SKU-{product_id:010d}", f"Product name {product_id}",
+                   Decimal(product_id % 100000) / 100 + Decimal('0.01'),
+                   product_id % brands + 1, 1)
+
+    def handle(self, *args, **options):
+        products, brands = options['products'], options['brands']
+        brand_names = {brand_id: f"Brand {brand_id}" for brand_id in range(1, brands + 1)}
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        snapshot = CatalogSnapshot()
+        snapshot.build(self.rows(products, brands), brand_names)
+        build_time = time.perf_counter() - start
+        footprint = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        # Model instances footprint, for comparison (extrapolated from a sample)
+        sample = min(products, 10000)
+        brand_instances = {brand_id: Brand(id=brand_id, name=name)
+                           for brand_id, name in brand_names.items()}
+        tracemalloc.start()
+        instances = [Product(id=row[0], sku=row[1], name=row[2], price=row[3],
+                             brand=brand_instances[row[4]], version=row[5])
+                     for row in self.rows(sample, brands)]
+        instances_footprint = tracemalloc.get_traced_memory()[0] * products // sample
+        tracemalloc.stop()
+        del instances
+
+        with override_settings(CATALOG_SNAPSHOT_REFRESH_INTERVAL=float('inf')):
+            step = max(products // options['lookups'], 1)
+            start = time.perf_counter()
+            for product_id in range(1, products + 1, step):
+                snapshot.get(product_id)
+            lookup_time = (time.perf_counter() - start) / len(range(1, products + 1, step))
+            start = time.perf_counter()
+            snapshot.filter(brand="Brand 1")
+            filter_time = time.perf_counter() - start
+
+        self.stdout.write(f"Products: {products}, brands: {brands}")
+        self.stdout.write(f"Build time (with memory tracing): {build_time:.2f} s")
+        self.stdout.write(f"Snapshot footprint: {footprint / 2 ** 20:.1f} MiB "
+                          f"({footprint / products:.0f} bytes per product)")
+        self.stdout.write(f"Product instances footprint (estimated): "
+                          f"{instances_footprint / 2 ** 20:.1f} MiB "
+                          f"({instances_footprint / products:.0f} bytes per product)")
+        self.stdout.write(f"Retrieve by ID: {lookup_time * 1e6:.1f} us")
+        self.stdout.write(f"Filter by brand: {filter_time * 1e3:.1f} ms")
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from products.visits import compact, visit_buffer
+
+class Command(BaseCommand):
+    """ Compacts visits rollups (minute -> hour -> day) and applies retention.
+        Meant to be run periodically (e.g. hourly, from a scheduler). """
+    help = "Compacts visits rollups and removes expired buckets"
+
+    def handle(self, *args, **options):
+        visit_buffer.flush()
+        removed = compact()
+        for resolution, count in removed.items():
+            self.stdout.write(f"{resolution}: {count} buckets removed")
@@ -0,0 +1,15 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from products.models import CatalogChange
+
+class Command(BaseCommand):
+    """ Removes catalog changes older than CATALOG_CHANGES_RETENTION.
+        Meant to be run periodically (e.g. daily, from a scheduler). """
+    help = "Removes old catalog changes"
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - settings.CATALOG_CHANGES_RETENTION
+        removed = CatalogChange.objects.filter(created__lt=cutoff).delete()[0]
+        self.stdout.write(f"{removed} catalog changes removed")
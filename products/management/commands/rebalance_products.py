@@ -0,0 +1,72 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connections, transaction
+
+from products.models import Product, ProductLocation
+from products.sharding import get_shards, is_sharded, shard_for_brand
+
+class Command(BaseCommand):
+    """ Moves products to their brand shard and fills the products directory.
+        Run it after enabling sharding (products are in the default database)
+        and after changing PRODUCT_SHARDS. """
+    help = "Moves products to the shard of their brand"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Products read from a shard at once")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only report how many products would be moved")
+
+    def handle(self, *args, **options):
+        if not is_sharded():
+            raise CommandError("Products are not sharded (PRODUCT_SHARDS is empty).")
+        sources = get_shards()
+        if 'default' not in sources: # Products created before sharding
+            sources = sources + ['default']
+        total = 0
+        for source in sources:
+            moved = self.rebalance(source, options['batch_size'], options['dry_run'])
+            self.stdout.write(f"{source}: {moved} products moved")
+            total += moved
+        if not options['dry_run']:
+            # New product IDs must not collide with the IDs added to the directory
+            connection = connections[ProductLocation.objects.db]
+            with connection.cursor() as cursor:
+                for sql in connection.ops.sequence_reset_sql(no_style(), [ProductLocation]):
+                    cursor.execute(sql)
+        self.stdout.write(self.style.SUCCESS(f"{total} products moved"))
+
+    def rebalance(self, source, batch_size, dry_run):
+        """ Moves products of a database to their shard, by batches.
+            Returns the number of products moved. """
+        moved = 0
+        last_id = 0
+        while True:
+            batch = list(Product.objects.using(source).filter(id__gt=last_id)
+                         .order_by('id')[:batch_size])
+            if not batch:
+                return moved
+            last_id = batch[-1].id
+            targets = defaultdict(list)
+            for product in batch:
+                targets[shard_for_brand(product.brand_id)].append(product)
+            for target, products in targets.items():
+                if target != source:
+                    moved += len(products)
+                if dry_run:
+                    continue
+                ids = [product.id for product in products]
+                ProductLocation.objects.bulk_create(
+                    [ProductLocation(id=product_id, shard=target) for product_id in ids],
+                    ignore_conflicts=True
+                )
+                if target == source:
+                    continue
+                # Copy before removing, so a failure never loses products
+                with transaction.atomic(using=target):
+                    Product.objects.using(target).bulk_create(products)
+                # Raw delete: related visits are in the default database
+                Product.objects.using(source).filter(id__in=ids)._raw_delete(source)
+                ProductLocation.objects.filter(id__in=ids).update(shard=target)
@@ -0,0 +1,110 @@
+import math
+import threading
+import time
+
+from importlib import import_module
+
+from django.conf import settings
+from django.http import JsonResponse
+from django.urls import reverse
+
+def get_queue_delay(request):
+    """ Returns seconds the request waited before reaching the app, from the
+        X-Request-Start header set by the router/proxy (None if missing).
+        Accepts times in seconds (optionally prefixed by 't='), milliseconds
+        or microseconds since the epoch. """
+    header = request.META.get('HTTP_X_REQUEST_START')
+    if not header:
+        return None
+    try:
+        start = float(header.strip().lstrip('t='))
+    except ValueError:
+        return None
+    if start > 1e14: # Microseconds
+        start /= 1e6
+    elif start > 1e11: # Milliseconds
+        start /= 1e3
+    return max(time.time() - start, 0.0)
+
+# Session engines whose sessions can be checked without a database query
+CACHED_SESSION_ENGINES = ('django.contrib.sessions.backends.cache',
+                          'django.contrib.sessions.backends.signed_cookies')
+
+LOGIN_COOKIE_SALT = 'products.middleware.login'
+
+def has_session(request):
+    """ Returns whether the request comes from a logged in user, without
+        querying the database (shedding is meant to spare it).
+        Sessions are verified when they are not stored in the database (see
+        CACHED_SESSION_ENGINES). Otherwise, the request must also send the
+        signed LOAD_SHEDDING_LOGIN_COOKIE set at login (see set_login_cookie),
+        which holds the session key: a session cookie alone is not trusted,
+        as anyone can send one. """
+    session_key = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    if not session_key:
+        return False
+    if settings.SESSION_ENGINE in CACHED_SESSION_ENGINES:
+        session = import_module(settings.SESSION_ENGINE).SessionStore(session_key)
+        return bool(session.load()) # Empty when missing, expired or tampered
+    login_key = request.get_signed_cookie(settings.LOAD_SHEDDING_LOGIN_COOKIE, None,
+                                          salt=LOGIN_COOKIE_SALT,
+                                          max_age=settings.SESSION_COOKIE_AGE)
+    return login_key == session_key
+
+def set_login_cookie(request, response):
+    """ Sets (or deletes, after logout) the login cookie of has_session, when
+        the user logged in or out during the request """
+    if not getattr(request, 'login_cookie_changed', False):
+        return
+    session_key = request.session.session_key
+    if request.user.is_authenticated and session_key:
+        response.set_signed_cookie(
+            settings.LOAD_SHEDDING_LOGIN_COOKIE, session_key, salt=LOGIN_COOKIE_SALT,
+            max_age=settings.SESSION_COOKIE_AGE, secure=settings.SESSION_COOKIE_SECURE,
+            httponly=True, samesite=settings.SESSION_COOKIE_SAMESITE
+        )
+    else:
+        response.delete_cookie(settings.LOAD_SHEDDING_LOGIN_COOKIE,
+                               samesite=settings.SESSION_COOKIE_SAMESITE)
+
+class LoadSheddingMiddleware:
+    """ Sheds anonymous requests while the worker is overloaded.
+        Overload is measured by the request queue delay (see get_queue_delay),
+        smoothed with an exponential moving average, so isolated slow requests
+        don't trigger shedding. While the average is above
+        LOAD_SHEDDING_MAX_QUEUE_DELAY, anonymous requests (see has_session)
+        get 503 with a Retry-After header, without touching the database.
+        Logged in users and LOAD_SHEDDING_EXEMPT_URLS (login pages, so users
+        can still log in) are never shed. Responses to logins and logouts set
+        the cookie identifying logged in users (see has_session). """
+    smoothing = 0.2 # Weight of the last request in the moving average
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self._lock = threading.Lock()
+        self.average_delay = 0.0
+        self._exempt_paths = None
+
+    def is_exempt(self, request):
+        """ Returns whether the request path is never shed """
+        if self._exempt_paths is None: # URLs are not loaded yet at init
+            self._exempt_paths = {reverse(name) for name in settings.LOAD_SHEDDING_EXEMPT_URLS}
+        return request.path_info in self._exempt_paths
+
+    def __call__(self, request):
+        delay = get_queue_delay(request)
+        if delay is not None:
+            with self._lock:
+                self.average_delay += self.smoothing * (delay - self.average_delay)
+                average_delay = self.average_delay
+            if average_delay > settings.LOAD_SHEDDING_MAX_QUEUE_DELAY and \
+                    not self.is_exempt(request) and not has_session(request):
+                response = JsonResponse(
+                    {'detail': 'Service temporarily overloaded. Try again later.'},
+                    status=503
+                )
+                response['Retry-After'] = str(max(1, math.ceil(2 * average_delay)))
+                return response
+        response = self.get_response(request)
+        set_login_cookie(request, response)
+        return response
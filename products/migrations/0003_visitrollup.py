@@ -0,0 +1,32 @@
+# Generated by Django 3.2.6 on 2026-10-19 18:09
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0002_search_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VisitRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.PositiveSmallIntegerField(choices=[(1, 'minute'), (2, 'hour'), (3, 'day')])),
+                ('start', models.DateTimeField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='visit_rollups', to='products.product')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='visitrollup',
+            index=models.Index(fields=['resolution', 'start'], name='products_visitrollup_res_start'),
+        ),
+        migrations.AddConstraint(
+            model_name='visitrollup',
+            constraint=models.UniqueConstraint(fields=('product', 'resolution', 'start'), name='products_visitrollup_bucket'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 3.2.6 on 2026-10-19 18:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0003_visitrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductLocation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.CharField(max_length=100)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='product',
+            name='brand',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='products', to='products.brand'),
+        ),
+        migrations.AlterField(
+            model_name='visitrollup',
+            name='product',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='visit_rollups', to='products.product'),
+        ),
+    ]
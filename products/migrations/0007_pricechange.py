@@ -0,0 +1,29 @@
+# Generated by Django 3.2.6 on 2026-10-19 18:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0006_catalogchange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PriceChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('old_price', models.DecimalField(decimal_places=2, max_digits=8, null=True)),
+                ('price', models.DecimalField(decimal_places=2, max_digits=8)),
+                ('product', models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='price_changes', to='products.product')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='pricechange',
+            index=models.Index(fields=['product', 'created'], name='products_pricechange_created'),
+        ),
+    ]
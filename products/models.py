@@ -1,8 +1,15 @@
+from contextlib import ExitStack
 from decimal import Decimal
 
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import DEFERRED, F
 from django.contrib.auth.models import AbstractUser
+from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator
+from django.utils import timezone
+
+from .sharding import batched, is_sharded, shard_for_brand, sharded
 
 class User(AbstractUser):
     """ User model. Extends from Django User model.
@@ -14,12 +21,53 @@ class User(AbstractUser):
         unique=True
     )
 
-class Brand(models.Model):
+class VersionedModel(models.Model):
+    """ Abstract model with a version counter, for optimistic concurrency control.
+        Every update (save_if_version or save) increments the version, so an
+        update based on an outdated read can be detected without locking the row.
+
+    Attributes:
+
+    + version: number of updates of the instance (starting at 1)
+    """
+    version = models.PositiveIntegerField(
+        default=1,
+        editable=False # Only incremented by saves
+    )
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        """ Saves instance, incrementing its version when it is updated (e.g.
+            from the admin site), so requests based on older reads fail """
+        if not self._state.adding:
+            self.version += 1
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = {*kwargs['update_fields'], 'version'}
+        return super(VersionedModel, self).save(*args, **kwargs)
+
+    def save_if_version(self, version, fields):
+        """ Saves fields and increments version, in a single conditional UPDATE,
+            only if the stored version is still the given one.
+
+            Returns bool indicating if the instance was saved. """
+        values = {name: getattr(self, name) for name in fields}
+        updated = type(self)._base_manager.using(self._state.db) \
+            .filter(pk=self.pk, version=version).update(version=F('version') + 1, **values)
+        if updated:
+            self.version = version + 1
+            CatalogChange.log(self) # Queryset updates don't send post_save
+        return bool(updated)
+
+class Brand(VersionedModel):
     """ Brand model
     
     Attributes:
 
     + name: brand name (unique)
+
+    + version: see VersionedModel
     """
     name = models.CharField(
         max_length=30,
@@ -47,7 +95,18 @@ class Brand(models.Model):
             info_str += f"\n\tname: {old_self.name} -> {self.name}"
         return info_str
 
-class Product(models.Model):
+    def delete(self, *args, **kwargs):
+        """ Deletes brand. When products are sharded, its products are deleted
+            from their shard first (cascades don't cross databases). """
+        if is_sharded():
+            for product_ids in batched(self.products.values_list('id', flat=True).iterator()):
+                VisitRollup.objects.filter(product_id__in=product_ids).delete()
+                PriceChange.objects.filter(product_id__in=product_ids).delete()
+                ProductLocation.objects.filter(id__in=product_ids).delete()
+            self.products.all().delete()
+        return super(Brand, self).delete(*args, **kwargs)
+
+class Product(VersionedModel):
     """ Product model
 
     Attributes:
@@ -61,6 +120,8 @@ class Product(models.Model):
     + brand: product brand
 
     + visits: visits count of anonymous users
+
+    + version: see VersionedModel
     """
     sku = models.CharField(
         max_length=255,
@@ -68,7 +129,8 @@ class Product(models.Model):
         verbose_name="SKU"
     )
     name = models.CharField(
-        max_length=255
+        max_length=255,
+        db_index=True # Admin search
     )
     price = models.DecimalField(
         max_digits=8,
@@ -77,19 +139,129 @@ class Product(models.Model):
     brand = models.ForeignKey(
         Brand,
         on_delete=models.CASCADE,
-        related_name="products"
+        related_name="products",
+        db_constraint=False # Brands and products may be in different databases
     )
     visits = models.PositiveIntegerField(
         default=0
     )
 
+    _loaded_price = None # Price read from the database (see PriceChange)
+
     def __str__(self):
         return f"{self.name} ({self.sku})"
 
-    def update_visits(self):
-        """ Updates visits count """
-        self.visits += 1
+    @classmethod
+    def sku_taken(cls, sku, product_id=None):
+        """ Returns whether a product (other than the given one) has the SKU,
+            in any shard (each shard only enforces it for its own products) """
+        products = cls.objects.filter(sku=sku)
+        if product_id is not None:
+            products = products.exclude(id=product_id)
+        return any(shard_products.exists() for shard_products in sharded(products))
+
+    def validate_unique(self, exclude=None):
+        """ Validates unique fields (e.g. in admin forms). When products are
+            sharded, the SKU is checked in every shard too (see sku_taken). """
+        super(Product, self).validate_unique(exclude)
+        if is_sharded() and 'sku' not in (exclude or ()) and self.sku_taken(self.sku, self.pk):
+            raise ValidationError({'sku': [self.unique_error_message(Product, ('sku', ))]})
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """ Creates instance read from the database, keeping its price
+            (DEFERRED when not read, e.g. with only() or defer()) """
+        instance = super(Product, cls).from_db(db, field_names, values)
+        instance._loaded_price = instance.__dict__.get('price', DEFERRED)
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        """ Reloads fields from the database (deferred fields are loaded this
+            way too), keeping the price read """
+        super(Product, self).refresh_from_db(using, fields)
+        if fields is None or 'price' in fields:
+            self._loaded_price = self.price
+
+    def read_stored_price(self):
+        """ Reads the stored price, when the product was read without it
+            (deferred) but its price was set since, so its change can be recorded """
+        if self._loaded_price is DEFERRED and 'price' in self.__dict__ and self.pk is not None:
+            self._loaded_price = type(self)._base_manager.using(self._state.db) \
+                .filter(pk=self.pk).values_list('price', flat=True).first()
+
+    def atomic(self):
+        """ Returns context manager running a transaction in each database
+            written by save: the default database (price history, products
+            directory) and, when products are sharded, the product shards
+            (current and target one). Errors roll back every database, but
+            they are committed one by one (no two-phase commit), so a failure
+            while committing may still leave them inconsistent. """
+        aliases = {'default'}
+        if is_sharded():
+            aliases.add(shard_for_brand(self.brand_id))
+            if self._state.db is not None:
+                aliases.add(self._state.db)
+        stack = ExitStack()
+        for alias in sorted(aliases):
+            stack.enter_context(transaction.atomic(using=alias))
+        return stack
+
+    def save(self, *args, **kwargs):
+        """ Saves product (see save_to_shard) and records its price change """
+        self.read_stored_price()
+        with self.atomic():
+            self.save_to_shard(*args, **kwargs)
+            PriceChange.record([self])
+
+    def save_to_shard(self, *args, **kwargs):
+        """ Saves product. When products are sharded, the product is saved in
+            its brand shard (moving it when its brand changed), and the ID of
+            new products is allocated from the products directory. """
+        if not is_sharded():
+            return super(Product, self).save(*args, **kwargs)
+        kwargs['using'] = shard_for_brand(self.brand_id)
+        if self.pk is None:
+            self.id = ProductLocation.objects.create(shard=kwargs['using']).id
+            kwargs['force_insert'] = True
+            return super(Product, self).save(*args, **kwargs)
+        old_shard = self._state.db
+        if old_shard is None or old_shard == kwargs['using']:
+            return super(Product, self).save(*args, **kwargs)
+        # Brand changed to another shard: copy the product before removing it
+        kwargs['force_insert'] = True
+        kwargs.pop('force_update', None)
+        kwargs.pop('update_fields', None)
+        super(Product, self).save(*args, **kwargs)
+        # Raw delete: related visits are in the default database
+        Product.objects.using(old_shard).filter(id=self.id)._raw_delete(old_shard)
+        ProductLocation.objects.update_or_create(id=self.id, defaults={'shard': kwargs['using']})
+        return None
+
+    def delete(self, *args, **kwargs):
+        """ Deletes product. When products are sharded, related rows in the
+            default database are deleted too (cascades don't cross databases). """
+        if is_sharded():
+            self.visit_rollups.all().delete()
+            self.price_changes.all().delete()
+            ProductLocation.objects.filter(id=self.id).delete()
+        return super(Product, self).delete(*args, **kwargs)
+
+    def save_if_version(self, version, fields):
+        """ Saves fields if the stored version is still the given one (see
+            VersionedModel), and records its price change. When products are
+            sharded and the brand changed to another shard, the version is
+            claimed before moving the product. """
+        if not is_sharded() or shard_for_brand(self.brand_id) == self._state.db:
+            self.read_stored_price()
+            with self.atomic():
+                if not super(Product, self).save_if_version(version, fields):
+                    return False
+                PriceChange.record([self])
+                return True
+        if not super(Product, self).save_if_version(version, ()):
+            return False
         self.save()
+        return True
 
     def get_info_str(self):
         """ Returns product information as a string """
@@ -119,3 +291,176 @@ class Product(models.Model):
         if self.brand != old_self.brand:
             info_str += f"\n\tbrand: {old_self.brand} -> {self.brand}"
         return info_str
+
+
+class ProductLocation(models.Model):
+    """ Products directory. Used when products are sharded: it allocates
+        product IDs (unique across shards) and maps each product to its shard.
+
+    Attributes:
+
+    + shard: database alias holding the product
+    """
+    shard = models.CharField(
+        max_length=100
+    )
+
+    @classmethod
+    def get_shard(cls, product_id):
+        """ Returns database alias holding a product (default database for
+            products not in the directory, e.g. created before sharding) """
+        location = cls.objects.filter(id=product_id).values_list('shard', flat=True).first()
+        return location or 'default'
+
+class VisitRollup(models.Model):
+    """ Anonymous visits of a product, aggregated in a time bucket.
+        Minute buckets are compacted into hour buckets, and hour buckets into
+        day buckets (see compact_visits command).
+
+    Attributes:
+
+    + product: visited product
+
+    + resolution: bucket size (minute, hour or day)
+
+    + start: bucket start time
+
+    + count: visits count in the bucket
+    """
+    class Resolution(models.IntegerChoices):
+        """ Bucket sizes, from finest to coarsest """
+        MINUTE = 1, 'minute'
+        HOUR = 2, 'hour'
+        DAY = 3, 'day'
+
+    product = models.ForeignKey(
+        Product,
+        on_delete=models.CASCADE,
+        related_name="visit_rollups",
+        db_constraint=False # Products may be in other databases
+    )
+    resolution = models.PositiveSmallIntegerField(
+        choices=Resolution.choices
+    )
+    start = models.DateTimeField()
+    count = models.PositiveIntegerField(
+        default=0
+    )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'resolution', 'start'],
+                                    name='products_visitrollup_bucket'),
+        ]
+        indexes = [ # Compaction scans
+            models.Index(fields=['resolution', 'start'], name='products_visitrollup_res_start'),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} {self.get_resolution_display()} {self.start}: {self.count}"
+
+
+class PriceChange(models.Model):
+    """ Product price history (append only). Each row is a price set at a
+        given time; the price of a product at any time is the one of its
+        latest change up to then.
+
+    Attributes:
+
+    + product: product
+
+    + created: change time
+
+    + old_price: price before the change (None when the product was created)
+
+    + price: price set
+    """
+    product = models.ForeignKey(
+        Product,
+        on_delete=models.CASCADE,
+        related_name="price_changes",
+        db_constraint=False, # Products may be in other databases
+        db_index=False # Covered by the (product, created) index
+    )
+    created = models.DateTimeField(
+        default=timezone.now
+    )
+    old_price = models.DecimalField(
+        max_digits=8,
+        decimal_places=2,
+        null=True
+    )
+    price = models.DecimalField(
+        max_digits=8,
+        decimal_places=2
+    )
+
+    class Meta:
+        indexes = [ # Price at a time, and changes in a range, of a product
+            models.Index(fields=['product', 'created'], name='products_pricechange_created'),
+        ]
+
+    @classmethod
+    def record(cls, products):
+        """ Records price changes of products, in a single insert.
+            Products prices are compared to the prices read from the database,
+            so it can be used after bulk operations too (e.g. bulk_update).
+            Products read without their price (deferred) are skipped, as their
+            previous price is unknown (see Product.read_stored_price). """
+        now = timezone.now()
+        products = [product for product in products if product._loaded_price is not DEFERRED]
+        changes = [cls(product_id=product.id, created=now, old_price=product._loaded_price,
+                       price=product.price)
+                   for product in products if product.price != product._loaded_price]
+        cls.objects.bulk_create(changes)
+        for product in products:
+            product._loaded_price = product.price
+
+    @classmethod
+    def get_price_at(cls, product, when):
+        """ Returns price of a product at a given time (None if it didn't exist) """
+        changes = cls.objects.filter(product=product)
+        change = changes.filter(created__lte=when).order_by('-created', '-id') \
+            .values_list('price').first()
+        if change is None: # Price before the first change
+            change = changes.filter(created__gt=when).order_by('created', 'id') \
+                .values_list('old_price').first()
+        if change is None: # Price never changed
+            return product.price
+        return change[0]
+
+class CatalogChange(models.Model):
+    """ Catalog changes log. Each product or brand write adds an entry, so
+        in-memory catalog snapshots (see replica.py) can be refreshed with the
+        changes made since the last entry they applied.
+
+    Attributes:
+
+    + model: changed model (product or brand)
+
+    + object_id: ID of the changed instance
+
+    + created: change time
+    """
+    class Model(models.IntegerChoices):
+        """ Logged models """
+        PRODUCT = 1, 'product'
+        BRAND = 2, 'brand'
+
+    model = models.PositiveSmallIntegerField(
+        choices=Model.choices
+    )
+    object_id = models.BigIntegerField()
+    created = models.DateTimeField(
+        auto_now_add=True,
+        db_index=True # Pruning
+    )
+
+    @classmethod
+    def log(cls, instance):
+        """ Logs a change of a product or brand (only when catalog snapshots
+            are enabled, see CATALOG_SNAPSHOT setting) """
+        if not settings.CATALOG_SNAPSHOT:
+            return
+        model = cls.Model.PRODUCT if isinstance(instance, Product) else cls.Model.BRAND
+        cls.objects.create(model=model, object_id=instance.pk)
@@ -0,0 +1,265 @@
+import heapq
+import threading
+import time
+
+from array import array
+from bisect import bisect_left
+from datetime import timedelta
+from decimal import Decimal
+from operator import itemgetter
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Brand, CatalogChange, Product
+from .sharding import sharded
+
+PRODUCT_FIELDS = ('id', 'sku', 'name', 'price', 'brand_id', 'version')
+
+class ProductRecord:
+    """ Product read from a catalog snapshot.
+        Provides the attributes used by anonymous users serializers. """
+    __slots__ = ('id', 'sku', 'name', 'price', 'brand', 'version')
+
+    def __init__(self, id, sku, name, price, brand, version):
+        self.id = id
+        self.sku = sku
+        self.name = name
+        self.price = price
+        self.brand = brand
+        self.version = version
+
+class _Columns:
+    """ Snapshot products, stored by column and sorted by ID.
+        Numbers are kept in typed arrays (prices in cents), so a product costs
+        a few machine words plus its SKU and name strings. """
+    __slots__ = ('ids', 'skus', 'names', 'prices', 'brand_ids', 'versions')
+
+    def __init__(self):
+        self.ids = array('q')
+        self.skus = []
+        self.names = []
+        self.prices = array('q')
+        self.brand_ids = array('q')
+        self.versions = array('q')
+
+    def append(self, row):
+        """ Appends a product row (see PRODUCT_FIELDS), with the highest ID """
+        self.ids.append(row[0])
+        self.skus.append(row[1])
+        self.names.append(row[2])
+        self.prices.append(int(row[3] * 100))
+        self.brand_ids.append(row[4])
+        self.versions.append(row[5])
+
+    def upsert(self, row):
+        """ Inserts or replaces a product row """
+        index = bisect_left(self.ids, row[0])
+        if index == len(self.ids) or self.ids[index] != row[0]:
+            self.ids.insert(index, row[0])
+            self.skus.insert(index, row[1])
+            self.names.insert(index, row[2])
+            self.prices.insert(index, int(row[3] * 100))
+            self.brand_ids.insert(index, row[4])
+            self.versions.insert(index, row[5])
+            return
+        self.skus[index] = row[1]
+        self.names[index] = row[2]
+        self.prices[index] = int(row[3] * 100)
+        self.brand_ids[index] = row[4]
+        self.versions[index] = row[5]
+
+    def remove(self, product_id):
+        """ Removes a product, if present """
+        index = bisect_left(self.ids, product_id)
+        if index < len(self.ids) and self.ids[index] == product_id:
+            for column in self.__slots__:
+                del getattr(self, column)[index]
+
+class CatalogSnapshot:
+    """ In-memory, per worker, read replica of products and brands.
+        Used to answer anonymous reads without querying the database when
+        CATALOG_SNAPSHOT is enabled. It is loaded on first use (or at worker
+        start) and refreshed at most every CATALOG_SNAPSHOT_REFRESH_INTERVAL
+        seconds, applying the catalog changes logged since the last refresh.
+
+        Changes are logged inside the writers transactions, so a change may
+        commit after another one with a higher ID. IDs skipped by a refresh
+        (gaps) are looked up again by the next refreshes, until they appear or
+        CATALOG_SNAPSHOT_GAP_TIMEOUT expires (e.g. rolled back writes). """
+
+    def __init__(self):
+        self._lock = threading.Lock() # Contents
+        self._refresh_lock = threading.RLock() # Database queries (see refresh)
+        self._columns = None
+        self._brands = {}
+        self._marker = 0 # Last catalog change applied
+        self._gaps = {} # {change ID: time}, IDs below the marker not seen yet
+        self._last_refresh = 0
+
+    @property
+    def enabled(self):
+        """ Returns whether anonymous reads use the snapshot """
+        return settings.CATALOG_SNAPSHOT
+
+    def build(self, rows, brands, marker=0, gaps=()):
+        """ Replaces snapshot contents.
+
+            Parameters:
+
+            + rows: product rows (see PRODUCT_FIELDS), sorted by ID.
+
+            + brands: dict of {brand_id: name}.
+
+            + marker: ID of the last catalog change included.
+
+            + gaps: IDs of catalog changes below marker not included.
+        """
+        columns = _Columns()
+        for row in rows:
+            columns.append(row)
+        with self._lock:
+            self._columns, self._brands, self._marker = columns, brands, marker
+            self._last_refresh = time.monotonic()
+            self._gaps = dict.fromkeys(gaps, self._last_refresh)
+
+    def load(self):
+        """ Loads the whole catalog from the database """
+        with self._refresh_lock:
+            # Changes of writes still running may commit later with lower IDs
+            since = timezone.now() - timedelta(seconds=settings.CATALOG_SNAPSHOT_GAP_TIMEOUT)
+            recent = set(CatalogChange.objects.filter(created__gte=since)
+                         .values_list('id', flat=True))
+            if recent:
+                marker = max(recent)
+                gaps = set(range(min(recent), marker)) - recent
+            else:
+                marker = CatalogChange.objects.order_by('-id') \
+                    .values_list('id', flat=True).first() or 0
+                gaps = ()
+            products = [shard_products.order_by('id').values_list(*PRODUCT_FIELDS).iterator()
+                        for shard_products in sharded(Product.objects.all())]
+            brands = dict(Brand.objects.values_list('id', 'name'))
+            self.build(heapq.merge(*products, key=itemgetter(0)), brands, marker, gaps)
+
+    def refresh(self, force=False):
+        """ Applies catalog changes logged since the last refresh (or loads
+            the catalog, on first use or after many changes).
+            One thread refreshes at a time, querying the database without
+            holding the snapshot lock: other threads keep reading the current
+            contents meanwhile (they only wait for the first load). """
+        with self._lock:
+            loaded = self._columns is not None
+            elapsed = time.monotonic() - self._last_refresh
+        if loaded and not force and elapsed < settings.CATALOG_SNAPSHOT_REFRESH_INTERVAL:
+            return None
+        if not self._refresh_lock.acquire(blocking=not loaded or force):
+            return None # Being refreshed by another thread
+        try:
+            return self._refresh(force)
+        finally:
+            self._refresh_lock.release()
+
+    def _refresh(self, force):
+        """ Refreshes the snapshot (see refresh), holding the refresh lock.
+            Marker and gaps are only used by refreshes, so only the contents
+            changes are made holding the snapshot lock. """
+        if self._columns is None:
+            return self.load()
+        elapsed = time.monotonic() - self._last_refresh
+        if not force and elapsed < settings.CATALOG_SNAPSHOT_REFRESH_INTERVAL:
+            return None # Refreshed by another thread meanwhile
+        if elapsed > settings.CATALOG_CHANGES_RETENTION.total_seconds():
+            return self.load() # Changes since last refresh may be pruned
+        self._last_refresh = time.monotonic()
+        pending = Q(id__gt=self._marker)
+        if self._gaps:
+            pending |= Q(id__in=list(self._gaps))
+        changes = list(CatalogChange.objects.filter(pending).order_by('id')
+                       .values_list('id', 'model', 'object_id')
+                       [:settings.CATALOG_SNAPSHOT_MAX_CHANGES + 1])
+        self._expire_gaps()
+        if not changes:
+            return None
+        if len(changes) > settings.CATALOG_SNAPSHOT_MAX_CHANGES:
+            return self.load()
+        product_ids = {object_id for _, model, object_id in changes
+                       if model == CatalogChange.Model.PRODUCT}
+        brand_ids = {object_id for _, model, object_id in changes
+                     if model == CatalogChange.Model.BRAND}
+        rows = {}
+        for shard_products in sharded(Product.objects.filter(id__in=product_ids)):
+            rows.update((row[0], row) for row in shard_products.values_list(*PRODUCT_FIELDS))
+        names = dict(Brand.objects.filter(id__in=brand_ids).values_list('id', 'name'))
+        with self._lock:
+            for product_id in product_ids:
+                if product_id in rows:
+                    self._columns.upsert(rows[product_id])
+                else:
+                    self._columns.remove(product_id)
+            for brand_id in brand_ids:
+                if brand_id in names:
+                    self._brands[brand_id] = names[brand_id]
+                else:
+                    self._brands.pop(brand_id, None)
+        self._track_gaps([change_id for change_id, _, _ in changes])
+        if len(self._gaps) > settings.CATALOG_SNAPSHOT_MAX_CHANGES:
+            return self.load()
+        return None
+
+    def _track_gaps(self, change_ids):
+        """ Moves the marker to the last change applied, recording the IDs
+            skipped (gaps) and forgetting the gaps filled """
+        for change_id in change_ids:
+            self._gaps.pop(change_id, None)
+        marker = max(self._marker, change_ids[-1])
+        now = time.monotonic()
+        for change_id in set(range(self._marker + 1, marker)) - set(change_ids):
+            self._gaps[change_id] = now
+        self._marker = marker
+
+    def _expire_gaps(self):
+        """ Forgets gaps older than CATALOG_SNAPSHOT_GAP_TIMEOUT """
+        expired = time.monotonic() - settings.CATALOG_SNAPSHOT_GAP_TIMEOUT
+        self._gaps = {change_id: since for change_id, since in self._gaps.items()
+                      if since > expired}
+
+    def _record(self, index):
+        columns = self._columns
+        return ProductRecord(
+            columns.ids[index], columns.skus[index], columns.names[index],
+            Decimal(columns.prices[index]).scaleb(-2), self._brands.get(columns.brand_ids[index]),
+            columns.versions[index]
+        )
+
+    def get(self, product_id):
+        """ Returns ProductRecord of a product (None if not found) """
+        self.refresh()
+        with self._lock:
+            ids = self._columns.ids
+            index = bisect_left(ids, product_id)
+            if index == len(ids) or ids[index] != product_id:
+                return None
+            return self._record(index)
+
+    def filter(self, brand=None):
+        """ Returns list of ProductRecord, ordered by ID.
+
+            Parameters:
+
+            + brand: brand name (all brands when None).
+        """
+        self.refresh()
+        with self._lock:
+            if brand is None:
+                return [self._record(index) for index in range(len(self._columns.ids))]
+            brand_ids = {brand_id for brand_id, name in self._brands.items() if name == brand}
+            return [self._record(index) for index, brand_id in enumerate(self._columns.brand_ids)
+                    if brand_id in brand_ids]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._columns.ids) if self._columns is not None else 0
+
+catalog_snapshot = CatalogSnapshot()
@@ -1,10 +1,14 @@
+from datetime import timedelta
+
 from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError
+from django.utils import timezone
 
 from rest_framework import serializers
 from rest_framework.reverse import reverse
 
-from .models import Brand, Product, User
+from .models import Brand, PriceChange, Product, User, VisitRollup
+from .sharding import is_sharded
 
 class UserSerializer(serializers.ModelSerializer):
     """ User serializer """
@@ -136,6 +140,12 @@ class ProductSerializer(serializers.ModelSerializer):
         request = self.context.get("request")
         return reverse("product-detail", kwargs={'pk': obj.id}, request=request)
 
+    def validate_sku(self, value):
+        """ Validates SKU is unique across product shards (see Product.sku_taken) """
+        if is_sharded() and Product.sku_taken(value, getattr(self.instance, 'id', None)):
+            raise serializers.ValidationError('product with this SKU already exists.')
+        return value
+
 class ProductListSerializer(ProductSerializer):
     """ Product serializer for list and retrieve actions """
     brand = BrandSerializer(read_only=True)
@@ -145,4 +155,53 @@ class ProductSerializerForAnon(ProductSerializer):
     brand = serializers.StringRelatedField()
     class Meta(ProductSerializer.Meta):
         fields = ('url', 'sku', 'name', 'price', 'brand')
-        read_only_fields = fields
\ No newline at end of file
+        read_only_fields = fields
+
+class VisitsQuerySerializer(serializers.Serializer):
+    """ Visits time series query parameters serializer """
+    resolution = serializers.ChoiceField(choices=VisitRollup.Resolution.labels, default='hour')
+    start = serializers.DateTimeField(required=False)
+    end = serializers.DateTimeField(required=False)
+
+    def validate(self, attrs):
+        """ Sets default time range (last day) and validates it """
+        attrs['resolution'] = getattr(VisitRollup.Resolution, attrs['resolution'].upper())
+        attrs['end'] = attrs.get('end') or timezone.now()
+        attrs['start'] = attrs.get('start') or attrs['end'] - timedelta(days=1)
+        if attrs['start'] >= attrs['end']:
+            raise serializers.ValidationError({'start': ['Must be earlier than end.']})
+        return attrs
+
+class VisitsSerializer(serializers.Serializer):
+    """ Visits time series bucket serializer """
+    start = serializers.DateTimeField(read_only=True)
+    visits = serializers.IntegerField(read_only=True)
+
+class PriceQuerySerializer(serializers.Serializer):
+    """ Price at a time query parameters serializer """
+    at = serializers.DateTimeField(required=False)
+
+    def validate(self, attrs):
+        """ Sets default time (now) """
+        attrs['at'] = attrs.get('at') or timezone.now()
+        return attrs
+
+class PriceChangesQuerySerializer(serializers.Serializer):
+    """ Price changes query parameters serializer """
+    start = serializers.DateTimeField(required=False)
+    end = serializers.DateTimeField(required=False)
+
+    def validate(self, attrs):
+        """ Sets default time range (last 30 days) and validates it """
+        attrs['end'] = attrs.get('end') or timezone.now()
+        attrs['start'] = attrs.get('start') or attrs['end'] - timedelta(days=30)
+        if attrs['start'] >= attrs['end']:
+            raise serializers.ValidationError({'start': ['Must be earlier than end.']})
+        return attrs
+
+class PriceChangeSerializer(serializers.ModelSerializer):
+    """ Price change serializer """
+
+    class Meta:
+        model = PriceChange
+        fields = ['created', 'old_price', 'price']
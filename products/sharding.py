@@ -0,0 +1,84 @@
+import heapq
+
+from itertools import islice
+from operator import attrgetter
+
+from django.conf import settings
+
+# Products app models stored in product shards. Every other model (brands,
+# users, visits rollups, products directory) lives in the default database.
+SHARDED_MODELS = ('product', )
+
+# Maximum IDs per query, when IDs read from a database filter another one
+# (below the SQLite bound parameters limit)
+BATCH_SIZE = 500
+
+def is_sharded():
+    """ Returns whether products are partitioned across several databases """
+    return bool(settings.PRODUCT_SHARDS)
+
+def get_shards():
+    """ Returns database aliases holding products """
+    return settings.PRODUCT_SHARDS or ['default']
+
+def shard_for_brand(brand_id):
+    """ Returns database alias holding the products of a brand.
+        Brands are spread across shards by their ID (modulo number of shards). """
+    shards = get_shards()
+    return shards[brand_id % len(shards)]
+
+def sharded(queryset):
+    """ Returns a copy of queryset for each shard """
+    return [queryset.using(alias) for alias in get_shards()]
+
+def merge_by_id(queryset):
+    """ Iterates over queryset objects of all shards, ordered by ID.
+        Each shard is queried once, already ordered, and results are merged. """
+    querysets = [shard_queryset.order_by('id') for shard_queryset in sharded(queryset)]
+    return heapq.merge(*querysets, key=attrgetter('id'))
+
+def batched(items, size=None):
+    """ Iterates over items in lists of at most size (BATCH_SIZE) items """
+    size = size or BATCH_SIZE
+    items = iter(items)
+    batch = list(islice(items, size))
+    while batch:
+        yield batch
+        batch = list(islice(items, size))
+
+def _is_sharded_model(model):
+    return model._meta.app_label == 'products' and model._meta.model_name in SHARDED_MODELS
+
+class ShardRouter:
+    """ Database router for sharded products (see PRODUCT_SHARDS setting).
+        Products are read from/written to their brand shard, every other
+        products app model uses the default database. Does nothing when
+        products are not sharded. """
+
+    def _db_for(self, model, **hints):
+        if not is_sharded() or model._meta.app_label != 'products':
+            return None
+        if not _is_sharded_model(model):
+            return 'default'
+        instance = hints.get('instance')
+        if instance is None:
+            return None
+        if _is_sharded_model(type(instance)):
+            return instance._state.db or shard_for_brand(instance.brand_id)
+        if type(instance)._meta.model_name == 'brand': # Brand products
+            return shard_for_brand(instance.pk)
+        return None
+
+    def db_for_read(self, model, **hints):
+        """ Returns database to read model from """
+        return self._db_for(model, **hints)
+
+    def db_for_write(self, model, **hints):
+        """ Returns database to write model to """
+        return self._db_for(model, **hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        """ Allows relations between products app models across databases """
+        if is_sharded() and obj1._meta.app_label == obj2._meta.app_label == 'products':
+            return True
+        return None
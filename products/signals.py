@@ -0,0 +1,21 @@
+from django.contrib.auth.signals import user_logged_in, user_logged_out
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Brand, CatalogChange, Product
+
+@receiver(post_save, sender=Brand)
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Brand)
+@receiver(post_delete, sender=Product)
+def log_catalog_change(sender, instance, **kwargs):
+    """ Logs product and brand changes, for catalog snapshots refresh """
+    CatalogChange.log(instance)
+
+@receiver(user_logged_in)
+@receiver(user_logged_out)
+def flag_login_cookie(sender, request, **kwargs):
+    """ Flags the request so the load shedding login cookie is updated in
+        its response (see middleware.has_session) """
+    if request is not None:
+        request.login_cookie_changed = True
@@ -1,3 +1,726 @@
-from django.test import TestCase
+import io
+import math
+import threading
+import time
 
-# Create your tests here.
+from contextlib import ExitStack, nullcontext, redirect_stderr
+from datetime import datetime, timedelta
+
+from decimal import Decimal
+from unittest import mock, skipIf, skipUnless
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from rest_framework.test import APIClient
+
+from .coalescing import SingleFlight
+from .middleware import LoadSheddingMiddleware
+from .models import Brand, CatalogChange, PriceChange, Product, ProductLocation, User, VisitRollup
+from .replica import CatalogSnapshot
+from .sharding import merge_by_id, shard_for_brand
+from .throttling import TokenBuckets, _take
+from .views import ProductViewSet
+from .visits import VisitBuffer, add_counts, compact
+from .warmup import warm_up_caches
+
+STATIC_STORAGE = 'django.contrib.staticfiles.storage.StaticFilesStorage' # No manifest
+
+@skipIf(settings.PRODUCT_SHARDS, "Products are sharded")
+@override_settings(STATICFILES_STORAGE=STATIC_STORAGE)
+class AdminQueriesTest(TestCase):
+    """ Admin views run a constant number of queries, whatever the table sizes """
+    brands = 200
+    products = 5000
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        Brand.objects.bulk_create([Brand(name=f"Brand {i:04d}") for i in range(cls.brands)])
+        brand_ids = list(Brand.objects.values_list('id', flat=True))
+        Product.objects.bulk_create([
+            Product(sku=f"SKU-{i:08d}", name=f"Product {i:08d}", price=Decimal('9.99'),
+                    brand_id=brand_ids[i % len(brand_ids)])
+            for i in range(cls.products)
+        ])
+        cls.product = Product.objects.order_by('id').last()
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def test_product_changelist(self):
+        with self.assertNumQueries(5):
+            response = self.client.get('/admin/products/product/')
+        self.assertEqual(response.status_code, 200)
+
+    def test_product_changelist_search(self):
+        with self.assertNumQueries(5):
+            response = self.client.get('/admin/products/product/', {'q': 'SKU-00000042'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['cl'].result_count, 1)
+
+    def test_product_change_form(self):
+        # Includes the savepoint pair of the admin view transaction, nested in the test one
+        with self.assertNumQueries(7):
+            response = self.client.get(f'/admin/products/product/{self.product.id}/change/')
+        self.assertEqual(response.status_code, 200)
+
+    def test_brand_autocomplete(self):
+        with self.assertNumQueries(4):
+            response = self.client.get('/admin/autocomplete/', {
+                'term': 'Brand', 'app_label': 'products', 'model_name': 'product',
+                'field_name': 'brand'
+            })
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['pagination']['more'])
+
+class VisitBufferTest(TestCase):
+    """ Buffered visits are written in batches, once """
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        brand = Brand.objects.create(name="Brand")
+        cls.products = [Product.objects.create(sku=f"SKU-{i}", name=f"Product {i}",
+                                               price=Decimal('1.00'), brand=brand)
+                        for i in range(3)]
+
+    def get_counts(self):
+        rollups = VisitRollup.objects.filter(resolution=VisitRollup.Resolution.MINUTE)
+        return (sorted(rollups.values_list('product_id', 'count')),
+                [(product.id, product.visits) for product in merge_by_id(Product.objects.all())])
+
+    def test_flush(self):
+        buffer = VisitBuffer(background=False)
+        when = timezone.now()
+        for product, visits in zip(self.products, (1, 1, 2)):
+            for _ in range(visits):
+                buffer.add(product.id, when)
+        with self.assertNumQueries(8) if not settings.PRODUCT_SHARDS else nullcontext():
+            # Existence check, bucket inserts, an update per increment, for rollups and products
+            buffer.flush()
+        ids = [product.id for product in self.products]
+        self.assertEqual(self.get_counts(), (list(zip(ids, (1, 1, 2))), list(zip(ids, (1, 1, 2)))))
+
+    def test_failed_write_is_retried_alone(self):
+        buffer = VisitBuffer(background=False)
+        product = self.products[0]
+        buffer.add(product.id)
+        with mock.patch('products.visits.add_product_visits', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                buffer.flush()
+        self.assertEqual(self.get_counts()[0], [(product.id, 1)])
+        buffer.flush()
+        counts = self.get_counts()
+        self.assertEqual(counts[0], [(product.id, 1)]) # Rollup not added twice
+        self.assertIn((product.id, 1), counts[1])
+
+    def test_background_flush(self):
+        flushed = threading.Event()
+        buffer = VisitBuffer()
+        with override_settings(VISITS_FLUSH_MAX_KEYS=1), \
+                mock.patch.object(buffer, 'flush', side_effect=lambda: flushed.set() or 1 / 0), \
+                self.assertLogs('products.visits', 'ERROR'):
+            buffer.add(self.products[0].id) # Doesn't write (nor fail) in the request
+            self.assertTrue(flushed.wait(5))
+            buffer._thread.join(0.5) # Let the thread log the error
+
+class CompactVisitsTest(TestCase):
+    """ Old visits buckets are rolled up into coarser ones, keeping totals """
+    databases = '__all__'
+
+    def test_compact(self):
+        brand = Brand.objects.create(name="Brand")
+        product = Product.objects.create(sku="SKU", name="Product", price=Decimal('1.00'),
+                                         brand=brand)
+        now = datetime(2021, 6, 10, 12, 30, tzinfo=timezone.utc)
+        def at(day, hour, minute=0, month=6, year=2021):
+            return datetime(year, month, day, hour, minute, tzinfo=timezone.utc)
+        resolutions = VisitRollup.Resolution
+        buckets = {
+            resolutions.MINUTE: {at(10, 9, 10): 3, at(10, 9, 50): 2, # Older than 2 hours
+                                 at(10, 10, 15): 1, at(10, 12, 20): 4},
+            resolutions.HOUR: {at(10, 9): 1, # Existing target bucket
+                               at(1, 5): 7, at(1, 6): 1}, # Older than 7 days
+            resolutions.DAY: {at(1, 0, year=2020, month=1): 9}, # Older than 365 days
+        }
+        for resolution, counts in buckets.items():
+            add_counts(resolution, {(product.id, start): count for start, count in counts.items()})
+
+        removed = compact(now)
+
+        self.assertEqual(removed, {'minute': 2, 'hour': 2, 'day': 1})
+        rollups = VisitRollup.objects.order_by('resolution', 'start')
+        self.assertEqual(list(rollups.values_list('resolution', 'start', 'count')), [
+            (resolutions.MINUTE, at(10, 10, 15), 1),
+            (resolutions.MINUTE, at(10, 12, 20), 4),
+            (resolutions.HOUR, at(10, 9), 6),
+            (resolutions.DAY, at(1, 0), 8),
+        ])
+        self.assertEqual(sum(rollups.values_list('count', flat=True)), 28 - 9) # Expired day
+
+class BrandTest(TestCase):
+    """ Brand operations over its products, in batches of IDs """
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        cls.brand = Brand.objects.create(name="Brand")
+        cls.products = [Product.objects.create(sku=f"SKU-{i}", name=f"Product {i}",
+                                               price=Decimal('1.00'), brand=cls.brand)
+                        for i in range(5)]
+        start = timezone.now().replace(minute=0, second=0, microsecond=0)
+        add_counts(VisitRollup.Resolution.MINUTE,
+                   {(product.id, start): 1 for product in cls.products})
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    @mock.patch('products.sharding.BATCH_SIZE', 2)
+    def test_visits(self):
+        response = self.client.get(f'/api/brands/{self.brand.id}/visits/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([bucket['visits'] for bucket in response.data], [5])
+
+    @mock.patch('products.sharding.BATCH_SIZE', 2)
+    @mock.patch('products.views.send_email_notification')
+    def test_delete(self, _):
+        response = self.client.delete(f'/api/brands/{self.brand.id}/',
+                                      HTTP_IF_MATCH=f'"{self.brand.version}"')
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(VisitRollup.objects.exists())
+        self.assertFalse(ProductLocation.objects.exists())
+        for alias in settings.PRODUCT_SHARDS or ['default']:
+            self.assertFalse(Product.objects.using(alias).exists())
+
+@skipUnless(settings.PRODUCT_SHARDS, "Products are not sharded")
+@override_settings(STATICFILES_STORAGE=STATIC_STORAGE)
+class ShardedAdminTest(TestCase):
+    """ Admin lists and edits products in their shards """
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        cls.brands = [Brand.objects.create(name=f"Brand {i}") for i in range(2)]
+        cls.products = [Product.objects.create(sku=f"SKU-{i}", name=f"Product {i}",
+                                               price=Decimal('1.00'), brand=brand)
+                        for i, brand in enumerate(cls.brands)]
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def test_changelist(self):
+        for product in self.products:
+            response = self.client.get('/admin/products/product/',
+                                       {'brand__id__exact': product.brand_id})
+            self.assertEqual(list(response.context['cl'].result_list), [product])
+            response = self.client.get('/admin/products/product/',
+                                       {'shard': product._state.db})
+            self.assertIn(product, response.context['cl'].result_list)
+
+    def test_duplicate_sku(self):
+        # Each shard only enforces SKU uniqueness for its own products
+        brand = next(brand for brand in self.brands
+                     if shard_for_brand(brand.id) != self.products[0]._state.db)
+        response = self.client.post('/admin/products/product/add/', {
+            'sku': self.products[0].sku, 'name': "Other", 'price': '2.00', 'brand': brand.id,
+            'visits': 0
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('sku', response.context['adminform'].form.errors)
+
+    def test_change_form(self):
+        for product in self.products:
+            response = self.client.get(f'/admin/products/product/{product.id}/change/')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.context['original'], product)
+
+@skipUnless(settings.PRODUCT_SHARDS, "Products are not sharded")
+@mock.patch('products.views.send_email_notification')
+class ShardedProductsTest(TestCase):
+    """ Products are stored in the shard of their brand """
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        cls.brands = [Brand.objects.create(name=f"Brand {i}") for i in range(4)]
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def create(self, sku, brand):
+        return self.client.post('/api/products/', {'sku': sku, 'name': sku, 'price': '1.00',
+                                                   'brand': brand.id}, format='json')
+
+    def get_shard(self, product_id):
+        return next(alias for alias in settings.PRODUCT_SHARDS
+                    if Product.objects.using(alias).filter(id=product_id).exists())
+
+    def test_list_merged_by_id(self, _):
+        ids = [self.create(f"SKU-{i}", self.brands[i % len(self.brands)]).data['id']
+               for i in range(8)]
+        self.assertEqual(len({self.get_shard(product_id) for product_id in ids}),
+                         len(settings.PRODUCT_SHARDS))
+        response = self.client.get('/api/products/')
+        self.assertEqual([product['id'] for product in response.data], ids)
+
+    def test_move(self, _):
+        product_id = self.create("SKU", self.brands[0]).data['id']
+        source = self.get_shard(product_id)
+        brand = next(brand for brand in self.brands if shard_for_brand(brand.id) != source)
+        url = f'/api/products/{product_id}/'
+        response = self.client.patch(url, {'brand': brand.id}, format='json',
+                                     HTTP_IF_MATCH=self.client.get(url)['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_shard(product_id), shard_for_brand(brand.id))
+        self.assertEqual(ProductLocation.get_shard(product_id), shard_for_brand(brand.id))
+        self.assertEqual(self.client.get(url).data['brand']['id'], brand.id)
+
+    def test_duplicate_sku(self, _):
+        self.assertEqual(self.create("SKU", self.brands[0]).status_code, 201)
+        brand = next(brand for brand in self.brands
+                     if shard_for_brand(brand.id) != shard_for_brand(self.brands[0].id))
+        response = self.create("SKU", brand)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('sku', response.data)
+
+    def test_rebalance(self, _):
+        # Products created before sharding are in the default database
+        Product.objects.using('default').bulk_create([
+            Product(id=i + 1, sku=f"SKU-{i}", name=f"Product {i}", price=Decimal('1.00'),
+                    brand=self.brands[i % len(self.brands)])
+            for i in range(10)
+        ])
+        call_command('rebalance_products', batch_size=3, stdout=io.StringIO())
+        self.assertFalse(Product.objects.using('default').exists())
+        for product_id in range(1, 11):
+            product = Product.objects.using(self.get_shard(product_id)).get(id=product_id)
+            self.assertEqual(product._state.db, shard_for_brand(product.brand_id))
+            self.assertEqual(ProductLocation.get_shard(product_id), product._state.db)
+        # New products IDs don't collide with the moved ones
+        self.assertEqual(self.create("SKU-new", self.brands[0]).data['id'], 11)
+
+@mock.patch('products.views.send_email_notification')
+class ConcurrentUpdatesTest(TestCase):
+    """ Updates and deletions require the ETag of the current version """
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        cls.brand = Brand.objects.create(name="Brand")
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+        self.url = f'/api/brands/{self.brand.id}/'
+        self.etag = self.client.get(self.url)['ETag']
+
+    def update(self, name, **headers):
+        return self.client.put(self.url, {'name': name}, format='json', **headers)
+
+    def test_update(self, _):
+        response = self.update("New", HTTP_IF_MATCH=self.etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], self.etag)
+        # Lost update: the instance changed since it was read
+        self.assertEqual(self.update("Other", HTTP_IF_MATCH=self.etag).status_code, 412)
+        self.assertEqual(Brand.objects.get().name, "New")
+
+    def test_admin_update(self, _):
+        # Saves from the admin site increment the version too
+        admin_client = APIClient()
+        admin_client.force_login(self.admin)
+        response = admin_client.post(f'/admin/products/brand/{self.brand.id}/change/',
+                                     {'name': "Admin"})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.update("New", HTTP_IF_MATCH=self.etag).status_code, 412)
+        self.assertEqual(Brand.objects.get().name, "Admin")
+
+    def test_missing_if_match(self, _):
+        self.assertEqual(self.update("New").status_code, 428)
+        self.assertEqual(self.client.delete(self.url).status_code, 428)
+        with override_settings(REQUIRE_IF_MATCH=False):
+            self.assertEqual(self.update("New").status_code, 200)
+
+    def test_weak_etag(self, _):
+        self.assertEqual(self.update("New", HTTP_IF_MATCH=f'W/{self.etag}').status_code, 412)
+        self.assertEqual(self.update("New", HTTP_IF_MATCH=f'"0", {self.etag}').status_code, 200)
+
+    def test_delete(self, _):
+        self.assertEqual(self.client.delete(self.url, HTTP_IF_MATCH='"0"').status_code, 412)
+        self.assertEqual(self.client.delete(self.url, HTTP_IF_MATCH=self.etag).status_code, 204)
+
+class SingleFlightTest(TestCase):
+    """ Concurrent identical calls run once """
+
+    def test_threads(self):
+        calls = SingleFlight('test')
+        release = threading.Event()
+        results = []
+        def call():
+            results.append(calls.do('key', lambda: release.wait(5) and 'result'))
+        threads = [threading.Thread(target=call) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        while calls.get_stats()['requests'] < len(threads):
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['result'] * 5)
+        self.assertEqual(calls.get_stats()['executions'], 1)
+
+    @override_settings(
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                'coalescing': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        COALESCING_CACHE='coalescing', COALESCING_LOCK_TIMEOUT=2
+    )
+    def test_failed_leader_in_other_worker(self):
+        leader, follower = SingleFlight('test'), SingleFlight('test') # Two workers
+        started, release = threading.Event(), threading.Event()
+        def fail():
+            started.set()
+            release.wait(5)
+            raise LookupError()
+        def lead():
+            with self.assertRaises(LookupError):
+                leader.do('key', fail)
+        thread = threading.Thread(target=lead)
+        thread.start()
+        started.wait(5)
+        threading.Timer(0.1, release.set).start()
+        start = time.monotonic()
+        with self.assertRaises(LookupError): # Not waiting for the lock timeout
+            follower.do('key', fail)
+        self.assertLess(time.monotonic() - start, 1)
+        thread.join()
+
+class CoalescedReadsTest(TestCase):
+    """ Concurrent anonymous retrievals of a product read it once """
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        brand = Brand.objects.create(name="Brand")
+        cls.product = Product.objects.create(sku="SKU", name="Product", price=Decimal('1.00'),
+                                             brand=brand)
+
+    def test_concurrent_retrieves(self):
+        reads, release = SingleFlight('test'), threading.Event()
+        # Product is read before the requests (test data isn't visible to other threads)
+        get_object = mock.Mock(side_effect=lambda: release.wait(5) and self.product)
+        responses = []
+        def retrieve():
+            responses.append(APIClient().get(f'/api/products/{self.product.id}/'))
+        with mock.patch('products.views.product_reads', reads), \
+                mock.patch('products.views.record_visit'), \
+                mock.patch.object(ProductViewSet, 'get_object', get_object):
+            threads = [threading.Thread(target=retrieve) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            while reads.get_stats()['requests'] < len(threads):
+                time.sleep(0.001)
+            release.set()
+            for thread in threads:
+                thread.join()
+            admin_client = APIClient()
+            admin_client.force_authenticate(self.admin)
+            stats = admin_client.get('/api/products/coalescing/').data
+        self.assertEqual(get_object.call_count, 1)
+        self.assertEqual([response.status_code for response in responses], [200] * 5)
+        self.assertEqual({response.data['sku'] for response in responses}, {"SKU"})
+        self.assertEqual(stats['requests'], 5)
+        self.assertEqual(stats['coalesced'], 4)
+
+class CatalogSnapshotTest(TestCase):
+    """ Snapshots apply logged catalog changes """
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.brand = Brand.objects.create(name="Brand")
+
+    def create_product(self, sku):
+        return Product.objects.create(sku=sku, name=sku, price=Decimal('1.00'), brand=self.brand)
+
+    def test_changes_not_logged_when_disabled(self):
+        with override_settings(CATALOG_SNAPSHOT=False):
+            self.create_product("SKU-1")
+        self.assertFalse(CatalogChange.objects.exists())
+
+    @override_settings(CATALOG_SNAPSHOT=True)
+    def test_change_committed_late(self):
+        snapshot = CatalogSnapshot()
+        snapshot.load()
+        first, second = self.create_product("SKU-1"), self.create_product("SKU-2")
+        # The first write commits after the second one (its change is not visible yet)
+        late_change = CatalogChange.objects.filter(object_id=first.id).values().get()
+        CatalogChange.objects.filter(id=late_change['id']).delete()
+        snapshot.refresh(force=True)
+        self.assertIsNone(snapshot.get(first.id))
+        self.assertIsNotNone(snapshot.get(second.id))
+        CatalogChange.objects.create(**late_change)
+        snapshot.refresh(force=True)
+        self.assertIsNotNone(snapshot.get(first.id))
+
+    @override_settings(CATALOG_SNAPSHOT=True, CATALOG_SNAPSHOT_GAP_TIMEOUT=0)
+    def test_gap_timeout(self):
+        snapshot = CatalogSnapshot()
+        snapshot.load()
+        first, second = self.create_product("SKU-1"), self.create_product("SKU-2")
+        CatalogChange.objects.filter(object_id=first.id).delete() # Rolled back
+        snapshot.refresh(force=True)
+        snapshot.refresh(force=True)
+        self.assertEqual(snapshot._gaps, {})
+
+    @override_settings(CATALOG_SNAPSHOT=True)
+    @mock.patch('products.views.send_email_notification')
+    @mock.patch('products.views.record_visit')
+    def test_anonymous_reads(self, *_):
+        product = self.create_product("SKU-1")
+        snapshot = CatalogSnapshot()
+        snapshot.load()
+        url = f'/api/products/{product.id}/'
+        admin_client = APIClient()
+        admin_client.force_authenticate(User.objects.create_superuser('admin', 'a@example.com', 'x'))
+        with mock.patch('products.views.catalog_snapshot', snapshot), \
+                mock.patch('products.throttling.local_buckets', TokenBuckets()):
+            with ExitStack() as stack: # Answered from the snapshot
+                for alias in settings.DATABASES:
+                    stack.enter_context(self.assertNumQueries(0, using=alias))
+                self.assertEqual(self.client.get(url).data['name'], "SKU-1")
+                self.assertEqual([p['sku'] for p in self.client.get('/api/products/').data],
+                                 ["SKU-1"])
+            response = admin_client.patch(url, {'name': "New"}, format='json',
+                                          HTTP_IF_MATCH=admin_client.get(url)['ETag'])
+            self.assertEqual(response.status_code, 200)
+            snapshot.refresh(force=True)
+            self.assertEqual(self.client.get(url).data['name'], "New")
+            self.assertEqual(self.client.get('/api/products/').data[0]['name'], "New")
+
+class WarmUpTest(TestCase):
+    """ Warm-up problems are reported with the startup report """
+
+    @override_settings(CATALOG_SNAPSHOT=True)
+    @mock.patch('products.warmup.catalog_snapshot.load', side_effect=DatabaseError("down"))
+    def test_warning_to_stderr(self, _):
+        stderr = io.StringIO()
+        with redirect_stderr(stderr):
+            warm_up_caches()
+        self.assertIn("Could not load catalog snapshot: down", stderr.getvalue())
+
+    @override_settings(CATALOG_SNAPSHOT=True)
+    @mock.patch('products.warmup.catalog_snapshot.load', side_effect=TypeError("bad option"))
+    def test_configuration_error(self, _):
+        # E.g. a database option the backend doesn't support: not fatal either
+        stderr = io.StringIO()
+        with redirect_stderr(stderr):
+            warm_up_caches()
+        self.assertIn("Could not load catalog snapshot: bad option", stderr.getvalue())
+
+class TokenBucketTest(TestCase):
+    """ Token buckets refill at their rate, up to their capacity """
+    databases = '__all__'
+
+    def test_take(self):
+        self.assertEqual(_take(10, 0, 10, 1, 0), (9, 0))
+        self.assertEqual(_take(0.5, 0, 10, 1, 0), (0.5, 0.5)) # Waits for the missing half token
+        self.assertEqual(_take(0, 0, 10, 2, 1), (1, 0)) # Refilled 2 tokens in 1 s
+        self.assertEqual(_take(5, 0, 10, 1, 100), (9, 0)) # Capped by capacity
+
+    def test_buckets(self):
+        buckets = TokenBuckets()
+        self.assertEqual([buckets.take('a', 2, 1, 0) for _ in range(3)], [0, 0, 1])
+        self.assertEqual(buckets.take('b', 2, 1, 0), 0) # Independent buckets
+        self.assertEqual(buckets.take('a', 2, 1, 1), 0)
+        with override_settings(THROTTLE_MAX_BUCKETS=1):
+            buckets.take('b', 2, 1, 1)
+            self.assertEqual(list(buckets._buckets), ['b']) # Least recently used dropped
+
+    @override_settings(CATALOG_SNAPSHOT=False)
+    @mock.patch('products.views.record_visit')
+    def test_throttled_request(self, _):
+        brand = Brand.objects.create(name="Brand")
+        product = Product.objects.create(sku="SKU", name="Product", price=Decimal('1.00'),
+                                         brand=brand)
+        client = APIClient(REMOTE_ADDR='192.0.2.1')
+        with mock.patch('products.throttling.local_buckets', TokenBuckets()), \
+                mock.patch('products.throttling.AnonProductRetrieveThrottle.THROTTLE_RATES',
+                           {'anon-product-retrieve': '2/min'}):
+            responses = [client.get(f'/api/products/{product.id}/') for _ in range(3)]
+        self.assertEqual([response.status_code for response in responses], [200, 200, 429])
+        self.assertEqual(responses[2]['Retry-After'], '30')
+
+    @override_settings(CATALOG_SNAPSHOT=False)
+    @mock.patch('products.views.record_visit')
+    def test_forwarded_for(self, _):
+        brand = Brand.objects.create(name="Brand")
+        product = Product.objects.create(sku="SKU", name="Product", price=Decimal('1.00'),
+                                         brand=brand)
+        client = APIClient(REMOTE_ADDR='10.0.0.1') # Router
+        with mock.patch('products.throttling.local_buckets', TokenBuckets()), \
+                mock.patch('products.throttling.AnonProductRetrieveThrottle.THROTTLE_RATES',
+                           {'anon-product-retrieve': '2/min'}):
+            # The client can send any X-Forwarded-For, the router appends its IP
+            responses = [client.get(f'/api/products/{product.id}/',
+                                    HTTP_X_FORWARDED_FOR=f'198.51.100.{i}, 192.0.2.1')
+                         for i in range(3)]
+            other_client = client.get(f'/api/products/{product.id}/',
+                                      HTTP_X_FORWARDED_FOR='192.0.2.2')
+        self.assertEqual([response.status_code for response in responses], [200, 200, 429])
+        self.assertEqual(other_client.status_code, 200)
+
+@override_settings(LOAD_SHEDDING_MAX_QUEUE_DELAY=1)
+class LoadSheddingTest(TestCase):
+    """ Anonymous requests are shed while requests queue too long """
+
+    def setUp(self):
+        self.middleware = LoadSheddingMiddleware(lambda request: HttpResponse())
+        self.factory = RequestFactory()
+
+    def get(self, path='/api/products/', delay=10, **kwargs):
+        started = time.time() - delay
+        return self.middleware(self.factory.get(path, HTTP_X_REQUEST_START=f't={started}', **kwargs))
+
+    def test_shedding(self):
+        self.assertEqual(self.get(delay=0).status_code, 200)
+        self.assertEqual(self.get(delay=0.5).status_code, 200) # Average below the limit
+        for _ in range(5):
+            response = self.get()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], str(math.ceil(2 * self.middleware.average_delay)))
+        self.assertEqual(self.get('/api/auth/login/').status_code, 200)
+        self.assertEqual(self.get('/admin/login/').status_code, 200)
+
+    def test_session(self):
+        for _ in range(5):
+            self.get()
+        User.objects.create_user('user', 'user@example.com', 'password')
+        response = self.client.post('/api/auth/login/', {'username': 'user', 'password': 'password'})
+        self.assertEqual(response.status_code, 302)
+        login_cookie = settings.LOAD_SHEDDING_LOGIN_COOKIE
+        for name in (settings.SESSION_COOKIE_NAME, login_cookie):
+            self.factory.cookies[name] = self.client.cookies[name].value
+        self.assertEqual(self.get().status_code, 200)
+        # Database sessions: session cookies without (valid) login cookie aren't trusted
+        self.factory.cookies[login_cookie] = 'forged'
+        self.assertEqual(self.get().status_code, 503)
+        del self.factory.cookies[login_cookie]
+        self.assertEqual(self.get().status_code, 503)
+        self.factory.cookies[settings.SESSION_COOKIE_NAME] = 'forged'
+        self.assertEqual(self.get().status_code, 503)
+        with override_settings(SESSION_ENGINE='django.contrib.sessions.backends.cache'):
+            self.assertEqual(self.get().status_code, 503)
+        # Logging out deletes the login cookie
+        self.client.post('/api/auth/logout/')
+        self.assertEqual(self.client.cookies[login_cookie].value, '')
+
+@mock.patch('products.views.send_email_notification')
+class PriceHistoryTest(TestCase):
+    """ Price changes are recorded with product writes and looked up by time """
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        cls.brand = Brand.objects.create(name="Brand")
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def create_product(self, price='10.00'):
+        return Product.objects.create(sku="SKU", name="Product", price=Decimal(price),
+                                      brand=self.brand)
+
+    def get_product(self, product_id):
+        return next(product for product in merge_by_id(Product.objects.all())
+                    if product.id == product_id)
+
+    def get_history(self, product):
+        return list(PriceChange.objects.filter(product=product).order_by('id')
+                    .values_list('old_price', 'price'))
+
+    def set_price(self, product, price):
+        url = f'/api/products/{product.id}/'
+        etag = self.client.get(url)['ETag']
+        response = self.client.patch(url, {'price': price}, format='json', HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_history(self, _):
+        product = self.create_product()
+        self.set_price(product, '12.50')
+        self.client.patch(f'/api/products/{product.id}/', {'name': "New"}, format='json',
+                          HTTP_IF_MATCH=self.client.get(f'/api/products/{product.id}/')['ETag'])
+        self.set_price(product, '9.99')
+        self.assertEqual(self.get_history(product), [
+            (None, Decimal('10.00')), (Decimal('10.00'), Decimal('12.50')),
+            (Decimal('12.50'), Decimal('9.99'))
+        ])
+
+    def test_price_at(self, _):
+        product = self.create_product()
+        self.set_price(product, '12.50')
+        self.set_price(product, '9.99')
+        start = datetime(2021, 1, 1, tzinfo=timezone.utc)
+        for days, change in enumerate(PriceChange.objects.filter(product=product).order_by('id')):
+            PriceChange.objects.filter(id=change.id).update(created=start + timedelta(days=days))
+        url = f'/api/products/{product.id}/price/'
+        def price_at(when):
+            return self.client.get(url, {'at': when.isoformat()})
+        self.assertEqual(price_at(start - timedelta(hours=1)).status_code, 404) # Before creation
+        self.assertEqual(price_at(start).data['price'], '10.00')
+        self.assertEqual(price_at(start + timedelta(hours=36)).data['price'], '12.50')
+        self.assertEqual(price_at(start + timedelta(days=3)).data['price'], '9.99')
+        self.assertEqual(self.client.get(url).data['price'], '9.99')
+
+    def test_price_changes_range(self, _):
+        product = self.create_product()
+        self.set_price(product, '12.50')
+        self.set_price(product, '9.99')
+        start = datetime(2021, 1, 1, tzinfo=timezone.utc)
+        for days, change in enumerate(PriceChange.objects.filter(product=product).order_by('id')):
+            PriceChange.objects.filter(id=change.id).update(created=start + timedelta(days=days))
+        url = f'/api/products/{product.id}/price_changes/'
+        def prices(start, end):
+            response = self.client.get(url, {'start': start.isoformat(), 'end': end.isoformat()})
+            return [change['price'] for change in response.data]
+        # Start included, end excluded
+        self.assertEqual(prices(start, start + timedelta(days=2)), ['10.00', '12.50'])
+        self.assertEqual(prices(start + timedelta(days=1), start + timedelta(days=3)),
+                         ['12.50', '9.99'])
+        self.assertEqual(prices(start - timedelta(days=1), start), [])
+        response = self.client.get(url, {'start': start.isoformat(), 'end': start.isoformat()})
+        self.assertEqual(response.status_code, 400)
+
+    def test_deferred_price(self, _):
+        product = self.create_product()
+        deferred = Product.objects.using(product._state.db).only('brand_id', 'name').get()
+        deferred.name = "New"
+        deferred.save()
+        self.assertEqual(self.get_history(product), [(None, Decimal('10.00'))]) # No fake entry
+        deferred = Product.objects.using(product._state.db).defer('price').get()
+        deferred.price = Decimal('5.00') # Set without reading it
+        deferred.save()
+        self.assertEqual(self.get_history(product)[-1], (Decimal('10.00'), Decimal('5.00')))
+
+    def test_failed_history_rolls_back(self, _):
+        product = self.create_product()
+        product.price = Decimal('5.00')
+        with mock.patch.object(PriceChange.objects, 'bulk_create', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                product.save()
+        self.assertEqual(self.get_product(product.id).price, Decimal('10.00'))
@@ -0,0 +1,97 @@
+import math
+import threading
+import time
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+from rest_framework.throttling import SimpleRateThrottle
+
+class TokenBuckets:
+    """ In-process token buckets (one per key).
+        A bucket holds up to `capacity` tokens and is refilled at `rate` tokens
+        per second; each request takes a token. Only the most recently used
+        THROTTLE_MAX_BUCKETS buckets are kept (dropped buckets start full). """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict() # {key: (tokens, time)}
+
+    def take(self, key, capacity, rate, now):
+        """ Takes a token from a bucket.
+            Returns seconds to wait for a token (0 when the token was taken). """
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (capacity, now))
+            tokens, wait = _take(tokens, last, capacity, rate, now)
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > settings.THROTTLE_MAX_BUCKETS:
+                self._buckets.popitem(last=False)
+        return wait
+
+class CacheTokenBuckets:
+    """ Token buckets stored in a Django cache, shared by the workers using it.
+        Buckets are read and written without locking, so concurrent requests
+        may occasionally take the same token. """
+
+    def __init__(self, alias):
+        self.cache = caches[alias]
+
+    def take(self, key, capacity, rate, now):
+        """ Takes a token from a bucket (see TokenBuckets.take) """
+        tokens, last = self.cache.get(key, (capacity, now))
+        tokens, wait = _take(tokens, last, capacity, rate, now)
+        self.cache.set(key, (tokens, now), timeout=math.ceil(capacity / rate))
+        return wait
+
+def _take(tokens, last, capacity, rate, now):
+    """ Refills tokens since last time, and takes one if available.
+        Returns tuple of (tokens left, seconds to wait for a token). """
+    tokens = min(capacity, tokens + (now - last) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) / rate
+
+local_buckets = TokenBuckets()
+
+class AnonTokenBucketThrottle(SimpleRateThrottle):
+    """ Token bucket throttle for anonymous users.
+        Rates are set per scope in DEFAULT_THROTTLE_RATES, as DRF rates: a rate
+        of 'n/period' allows bursts of n requests, refilled over the period.
+        Buckets are kept in memory (no database nor cache queries), or in
+        THROTTLE_CACHE when set. """
+    timer = time.monotonic
+
+    def get_cache_key(self, request, view):
+        """ Returns bucket key (None for authenticated users) """
+        if request.user and request.user.is_authenticated:
+            return None
+        return self.cache_format % {'scope': self.scope, 'ident': self.get_ident(request)}
+
+    def allow_request(self, request, view):
+        """ Takes a token from the client bucket """
+        if self.rate is None:
+            return True
+        key = self.get_cache_key(request, view)
+        if key is None:
+            return True
+        buckets = local_buckets
+        if settings.THROTTLE_CACHE:
+            buckets = CacheTokenBuckets(settings.THROTTLE_CACHE)
+            self.timer = time.time # Shared by processes
+        self.wait_time = buckets.take(key, self.num_requests, self.num_requests / self.duration,
+                                      self.timer())
+        return self.wait_time == 0
+
+    def wait(self):
+        """ Returns seconds until a token is available """
+        return self.wait_time
+
+class AnonProductListThrottle(AnonTokenBucketThrottle):
+    """ Products list throttle (lists the whole catalog) """
+    scope = 'anon-product-list'
+
+class AnonProductRetrieveThrottle(AnonTokenBucketThrottle):
+    """ Product retrieval throttle """
+    scope = 'anon-product-retrieve'
@@ -1,19 +1,28 @@
 from collections import OrderedDict
 
-from django.db import transaction
+from django.conf import settings
+from django.db.models import QuerySet
 from django.urls import NoReverseMatch
 
 from rest_framework import viewsets, status, routers
 from rest_framework.decorators import action
+from rest_framework.exceptions import APIException
 from rest_framework.response import Response
 from rest_framework.reverse import reverse
 from rest_framework.permissions import IsAuthenticated, AllowAny
 
-from .models import Brand, Product, User
+from .models import Brand, PriceChange, Product, ProductLocation, User, VisitRollup
+from .sharding import batched, is_sharded, merge_by_id
+from .throttling import AnonProductListThrottle, AnonProductRetrieveThrottle
+from .coalescing import product_reads
+from .replica import catalog_snapshot
 from .utils import send_email_notification
+from .visits import add_series, get_series, record_visit
 
 from .serializers import (BrandSerializer, ProductSerializer, ProductSerializerForAnon, 
-    UserSerializer, UserRegistrationSerializer, ChangePasswordSerializer, ProductListSerializer)
+    UserSerializer, UserRegistrationSerializer, ChangePasswordSerializer, ProductListSerializer,
+    VisitsQuerySerializer, VisitsSerializer, PriceQuerySerializer, PriceChangesQuerySerializer,
+    PriceChangeSerializer)
 
 class APIRootView(routers.APIRootView):
     """
@@ -83,14 +92,61 @@ class UserViewSet(viewsets.ModelViewSet):
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+class PreconditionFailed(APIException):
+    """ Instance was changed since the version sent in If-Match header """
+    status_code = status.HTTP_412_PRECONDITION_FAILED
+    default_detail = 'The instance was modified by another request. Retrieve it and try again.'
+    default_code = 'precondition_failed'
+
+class PreconditionRequired(APIException):
+    """ Update or deletion without If-Match header """
+    status_code = status.HTTP_428_PRECONDITION_REQUIRED
+    default_detail = 'If-Match header is required. Send the ETag of the instance retrieved.'
+    default_code = 'precondition_required'
+
 class BaseViewSet(viewsets.ModelViewSet):
-    """ Base viewset for brands and products. To allow notifications on updates/deletions """
+    """ Base viewset for brands and products. To allow notifications on updates/deletions.
+
+        Updates and deletions use optimistic concurrency control: instances are
+        versioned (see models.VersionedModel), their version is sent in the ETag
+        header, and must be sent back in the If-Match header (428 otherwise,
+        see REQUIRE_IF_MATCH setting). Writes only succeed if the instance is
+        still at that version, otherwise 412 is returned. """
+
+    def get_etag(self, instance):
+        """ Returns instance ETag """
+        return f'"{instance.version}"'
+
+    def get_expected_version(self, instance):
+        """ Returns instance version expected by the request (If-Match header).
+            Raises PreconditionRequired when the header is missing (unless
+            REQUIRE_IF_MATCH is off), and PreconditionFailed when it doesn't
+            match the instance read. ETags are compared with the strong
+            comparison (weak ETags never match). """
+        if_match = self.request.headers.get('If-Match')
+        if if_match is None:
+            if settings.REQUIRE_IF_MATCH:
+                raise PreconditionRequired()
+            return instance.version
+        if if_match.strip() == '*':
+            return instance.version
+        etags = [etag.strip() for etag in if_match.split(',')]
+        if self.get_etag(instance) not in etags:
+            raise PreconditionFailed()
+        return instance.version
+
+    def retrieve(self, request, *args, **kwargs):
+        """ Retrieves instance, with its ETag """
+        instance = self.get_object()
+        serializer = self.get_serializer(instance)
+        return Response(serializer.data, headers={'ETag': self.get_etag(instance)})
 
     def update(self, request, *args, **kwargs):
         """ Updates instance and sends email to notify other users """
         partial = kwargs.pop('partial', False)
         instance = self.get_object()
         old_instance = self.get_object() # To notify changes
+        self.expected_version = self.get_expected_version(instance)
         serializer = self.get_serializer(instance, data=request.data, partial=partial)
         serializer.is_valid(raise_exception=True)
         self.perform_update(serializer)
@@ -103,16 +159,41 @@ class BaseViewSet(viewsets.ModelViewSet):
         # Send email notification
         send_email_notification(self.request.user, old_instance, instance)
 
-        return Response(serializer.data)
+        return Response(serializer.data, headers={'ETag': self.get_etag(instance)})
+
+    def perform_update(self, serializer):
+        """ Saves updated fields with a conditional UPDATE on the expected version
+            (no row locks). Raises PreconditionFailed if another request changed
+            the instance in the meantime. """
+        instance = serializer.instance
+        for attr, value in serializer.validated_data.items():
+            setattr(instance, attr, value)
+        if not instance.save_if_version(self.expected_version, serializer.validated_data.keys()):
+            raise PreconditionFailed()
 
     def destroy(self, request, *args, **kwargs):
         """ Deletes instance and sends email to notify other users """
         instance = self.get_object()
+        # Claiming the version makes concurrent updates fail before deleting
+        if not instance.save_if_version(self.get_expected_version(instance), ()):
+            raise PreconditionFailed()
         self.perform_destroy(instance)
         # Send email notification
         send_email_notification(self.request.user, instance, None, False)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    def get_visits_response(self, request, rollups):
+        """ Returns visits time series response for given rollups (queryset, or
+            list of querysets whose series are added up).
+            Query parameters: resolution (minute, hour or day), start and end. """
+        query = VisitsQuerySerializer(data=request.query_params)
+        if not query.is_valid():
+            return Response(query.errors, status=status.HTTP_400_BAD_REQUEST)
+        if isinstance(rollups, QuerySet):
+            rollups = [rollups]
+        series = add_series(get_series(queryset, **query.validated_data) for queryset in rollups)
+        return Response(VisitsSerializer(series, many=True).data)
+
 class BrandViewSet(BaseViewSet):
     """ Viewset for brands """
     queryset = Brand.objects.all().order_by("id")
@@ -126,6 +207,16 @@ class BrandViewSet(BaseViewSet):
         serializer = ProductSerializer(brand.products.all(), many=True, context={'request': request})
         return Response(serializer.data, status=status.HTTP_200_OK)
 
+    @action(detail=True, methods=['get'])
+    def visits(self, request, pk=None):
+        """ Gets visits time series of all brand products """
+        brand = self.get_object()
+        rollups = VisitRollup.objects.filter(product__brand=brand)
+        if is_sharded(): # Brand products are not in the default database
+            product_ids = brand.products.values_list('id', flat=True).iterator()
+            rollups = [VisitRollup.objects.filter(product_id__in=ids) for ids in batched(product_ids)]
+        return self.get_visits_response(request, rollups)
+
 class ProductViewSet(BaseViewSet):
     """ Viewset for products """
     queryset = Product.objects.all().order_by("id")
@@ -140,6 +231,47 @@ class ProductViewSet(BaseViewSet):
             self.permission_classes = (AllowAny, )
         return super(ProductViewSet, self).get_permissions()
 
+    def get_throttles(self):
+        """ Get throttles for views.
+            Anonymous users have a budget of requests per action, stricter
+            for listing (see DEFAULT_THROTTLE_RATES). """
+        if self.action == 'list':
+            return [AnonProductListThrottle()]
+        if self.action == 'retrieve':
+            return [AnonProductRetrieveThrottle()]
+        return super(ProductViewSet, self).get_throttles()
+
+    def get_queryset(self):
+        """ Get products queryset.
+            Products list can be filtered by brand name (brand query parameter).
+            When products are sharded, a single product is looked up in its shard. """
+        queryset = super(ProductViewSet, self).get_queryset()
+        brand = self.request.query_params.get('brand')
+        if self.action == 'list' and brand is not None: # Brand name filter
+            brand_ids = list(Brand.objects.filter(name=brand).values_list('id', flat=True))
+            queryset = queryset.filter(brand_id__in=brand_ids)
+        if is_sharded() and 'pk' in self.kwargs:
+            try:
+                shard = ProductLocation.get_shard(int(self.kwargs['pk']))
+            except ValueError: # Invalid ID, get_object() responds not found
+                shard = 'default'
+            queryset = queryset.using(shard)
+        return queryset
+
+    def list(self, request, *args, **kwargs):
+        """ Listing products.
+            Anonymous users are answered from the catalog snapshot, if enabled.
+            When products are sharded, products of all shards are merged by ID. """
+        if self.request.user.is_anonymous and catalog_snapshot.enabled:
+            products = catalog_snapshot.filter(brand=request.query_params.get('brand'))
+            serializer = self.get_serializer(products, many=True)
+            return Response(serializer.data)
+        if not is_sharded():
+            return super(ProductViewSet, self).list(request, *args, **kwargs)
+        products = merge_by_id(self.get_queryset().prefetch_related('brand'))
+        serializer = self.get_serializer(products, many=True)
+        return Response(serializer.data)
+
     def get_serializer_class(self):
         """ Get serializer by user.
             Anonymous users cannot see database ID nor product visits. """
@@ -151,10 +283,65 @@ class ProductViewSet(BaseViewSet):
 
     def retrieve(self, request, *args, **kwargs):
         """ Retrieving a product.
-            When an anonymous user retrieves a product, increase visits. """
-        instance = self.get_object()
-        if self.request.user.is_anonymous:
-            with transaction.atomic(): # To prevent DB inconsistencies
-                instance.update_visits()
+            When an anonymous user retrieves a product, increase visits.
+            Concurrent anonymous reads of a product are coalesced: one of them
+            reads and serializes it, and the others share the result. """
+        if not self.request.user.is_anonymous:
+            return super(ProductViewSet, self).retrieve(request, *args, **kwargs)
+        # Product URL depends on the requested host
+        key = f"{kwargs[self.lookup_field]}:{request.scheme}://{request.get_host()}"
+        product = product_reads.do(key, self.read_product)
+        record_visit(product['id']) # Buffered, see visits.VisitBuffer
+        return Response(product['data'], headers={'ETag': product['etag']})
+
+    def read_product(self):
+        """ Reads and serializes the requested product, from the catalog
+            snapshot if enabled (products not found in it are read from the
+            database, as it may not include the latest changes yet).
+            Returns dict with its ID, ETag and serialized data. """
+        instance = None
+        if catalog_snapshot.enabled and self.kwargs[self.lookup_field].isdigit():
+            instance = catalog_snapshot.get(int(self.kwargs[self.lookup_field]))
+        if instance is None:
+            instance = self.get_object()
         serializer = self.get_serializer(instance)
-        return Response(serializer.data)
+        return {'id': instance.id, 'etag': self.get_etag(instance), 'data': dict(serializer.data)}
+
+    @action(detail=False, methods=['get'])
+    def coalescing(self, request):
+        """ Gets anonymous reads coalescing statistics of the worker """
+        return Response(product_reads.get_stats())
+
+    @action(detail=True, methods=['get'])
+    def visits(self, request, pk=None):
+        """ Gets product visits time series """
+        product = self.get_object()
+        return self.get_visits_response(request, product.visit_rollups.all())
+
+    @action(detail=True, methods=['get'])
+    def price(self, request, pk=None):
+        """ Gets product price at a time (at query parameter, now by default) """
+        product = self.get_object()
+        query = PriceQuerySerializer(data=request.query_params)
+        if not query.is_valid():
+            return Response(query.errors, status=status.HTTP_400_BAD_REQUEST)
+        at = query.validated_data['at']
+        price = PriceChange.get_price_at(product, at)
+        if price is None: # Product didn't exist yet
+            return Response({'detail': 'No price at that time.'}, status=status.HTTP_404_NOT_FOUND)
+        return Response({'at': at, 'price': str(price)})
+
+    @action(detail=True, methods=['get'])
+    def price_changes(self, request, pk=None):
+        """ Gets product price changes in a time range (start and end query
+            parameters, last 30 days by default) """
+        product = self.get_object()
+        query = PriceChangesQuerySerializer(data=request.query_params)
+        if not query.is_valid():
+            return Response(query.errors, status=status.HTTP_400_BAD_REQUEST)
+        changes = PriceChange.objects.filter(
+            product=product,
+            created__gte=query.validated_data['start'],
+            created__lt=query.validated_data['end']
+        ).order_by('created', 'id')
+        return Response(PriceChangeSerializer(changes, many=True).data)
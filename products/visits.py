@@ -0,0 +1,214 @@
+import atexit
+import logging
+import threading
+
+from collections import Counter, defaultdict
+from functools import partial
+
+from django.conf import settings
+from django.db import DatabaseError, connections, transaction
+from django.db.models import F, Sum
+from django.db.models.functions import Trunc
+from django.utils import timezone
+
+from .models import Product, VisitRollup
+from .sharding import BATCH_SIZE, batched, sharded
+
+logger = logging.getLogger(__name__)
+
+def group_by_value(counts):
+    """ Groups counts keys by value, so equal increments share a query.
+        Returns dict of {value: [keys]}. """
+    groups = defaultdict(list)
+    for key, value in counts.items():
+        groups[value].append(key)
+    return groups
+
+def add_counts(resolution, counts):
+    """ Adds visits counts to rollup buckets, creating missing buckets.
+        Buckets of the same start and increment are updated by a single query.
+
+        Parameters:
+
+        + resolution: VisitRollup.Resolution of the buckets.
+
+        + counts: dict of {(product_id, bucket_start): visits}.
+    """
+    if not counts:
+        return
+    # Visits of products removed in the meantime are dropped
+    product_ids = {product_id for product_id, _ in counts}
+    existing = set()
+    for ids in batched(product_ids):
+        for products in sharded(Product.objects.filter(id__in=ids)):
+            existing.update(products.values_list('id', flat=True))
+    counts = {key: value for key, value in counts.items() if key[0] in existing}
+    by_start = defaultdict(dict)
+    for (product_id, start), value in counts.items():
+        by_start[start][product_id] = value
+    with transaction.atomic():
+        VisitRollup.objects.bulk_create(
+            [VisitRollup(product_id=product_id, resolution=resolution, start=start)
+             for product_id, start in counts],
+            ignore_conflicts=True,
+            batch_size=BATCH_SIZE
+        )
+        for start, start_counts in by_start.items():
+            for value, ids in group_by_value(start_counts).items():
+                for batch in batched(ids):
+                    VisitRollup.objects.filter(
+                        product_id__in=batch, resolution=resolution, start=start
+                    ).update(count=F('count') + value)
+
+def add_product_visits(totals):
+    """ Adds visits counts to products visits count.
+        Products of the same increment (and shard) are updated by a single query.
+
+        Parameters:
+
+        + totals: dict of {product_id: visits}.
+    """
+    for value, ids in group_by_value(totals).items():
+        for batch in batched(ids):
+            for products in sharded(Product.objects.filter(id__in=batch)):
+                products.update(visits=F('visits') + value)
+
+class VisitBuffer:
+    """ In-process buffer of anonymous visits.
+        Visits are counted in memory per (product, minute) and written to the
+        minute rollups (and products visits count) in batches by a background
+        thread, every VISITS_FLUSH_INTERVAL seconds or as soon as
+        VISITS_FLUSH_MAX_KEYS buckets are pending, so requests never wait for
+        (or fail because of) the writes. Writes that fail are logged and
+        retried by the next flush. """
+
+    def __init__(self, background=True):
+        self.background = background # Flush from a thread (otherwise, call flush())
+        self._lock = threading.Lock()
+        self._counts = Counter() # {(product_id, minute): visits}, for rollups
+        self._totals = Counter() # {product_id: visits}, for products visits count
+        self._due = threading.Event()
+        self._thread = None
+
+    def add(self, product_id, when=None):
+        """ Counts a visit of a product, waking up the flush thread when due """
+        when = (when or timezone.now()).replace(second=0, microsecond=0)
+        with self._lock:
+            self._counts[(product_id, when)] += 1
+            self._totals[product_id] += 1
+            full = len(self._counts) >= settings.VISITS_FLUSH_MAX_KEYS
+            if self.background and (self._thread is None or not self._thread.is_alive()):
+                # Started on first use, so each (forked) worker has its own
+                self._thread = threading.Thread(target=self._run, name='visits-flush', daemon=True)
+                self._thread.start()
+        if full:
+            self._due.set()
+
+    def _run(self):
+        """ Flush thread loop """
+        while True:
+            self._due.wait(settings.VISITS_FLUSH_INTERVAL)
+            self._due.clear()
+            try:
+                self.flush()
+            except Exception: # Visits were kept for the next flush
+                logger.exception("Could not write buffered visits")
+            finally:
+                connections.close_all() # Connections of this thread
+
+    def flush(self):
+        """ Writes pending visits to the minute rollups and products visits count.
+            Each write is retried by the next flush if it fails (the other one
+            is not repeated). """
+        with self._lock:
+            counts, self._counts = self._counts, Counter()
+            totals, self._totals = self._totals, Counter()
+        errors = []
+        for write, pending, buffer in (
+                (partial(add_counts, VisitRollup.Resolution.MINUTE), counts, '_counts'),
+                (add_product_visits, totals, '_totals')):
+            try:
+                write(pending)
+            except Exception as exc:
+                with self._lock: # Keep visits for the next flush
+                    getattr(self, buffer).update(pending)
+                errors.append(exc)
+        if errors:
+            raise errors[0]
+
+visit_buffer = VisitBuffer()
+
+@atexit.register
+def flush_at_exit():
+    """ Writes pending visits when the worker shuts down """
+    try:
+        visit_buffer.flush()
+    except DatabaseError: # Database unavailable, pending visits are lost
+        pass
+
+def record_visit(product_id):
+    """ Records an anonymous visit of a product """
+    visit_buffer.add(product_id)
+
+def compact(now=None):
+    """ Compacts visits rollups.
+        Minute and hour buckets older than their retention are rolled into the
+        next resolution, and day buckets older than their retention are removed.
+
+        Returns dict of {resolution: buckets removed}.
+    """
+    now = now or timezone.now()
+    retention = settings.VISITS_RETENTION
+    resolutions = VisitRollup.Resolution
+    removed = {}
+    for resolution, target in ((resolutions.MINUTE, resolutions.HOUR),
+                               (resolutions.HOUR, resolutions.DAY)):
+        # Only complete target buckets are rolled up
+        cutoff = truncate(now - retention[resolution.label], target)
+        with transaction.atomic():
+            rollups = VisitRollup.objects.filter(resolution=resolution, start__lt=cutoff)
+            totals = rollups.annotate(bucket=Trunc('start', target.label, tzinfo=timezone.utc)) \
+                .values('product_id', 'bucket').annotate(total=Sum('count')).order_by()
+            add_counts(target, {(row['product_id'], row['bucket']): row['total']
+                                for row in totals})
+            removed[resolution.label] = rollups.delete()[0]
+    cutoff = now - retention[resolutions.DAY.label]
+    removed[resolutions.DAY.label] = VisitRollup.objects.filter(
+        resolution=resolutions.DAY, start__lt=cutoff).delete()[0]
+    return removed
+
+def truncate(when, resolution):
+    """ Returns the start of the bucket of given resolution containing when """
+    when = timezone.localtime(when, timezone.utc).replace(second=0, microsecond=0)
+    if resolution >= VisitRollup.Resolution.HOUR:
+        when = when.replace(minute=0)
+    if resolution >= VisitRollup.Resolution.DAY:
+        when = when.replace(hour=0)
+    return when
+
+def get_series(rollups, resolution, start, end):
+    """ Returns visits time series as a list of {"start": datetime, "visits": int}.
+        Buckets finer than the requested resolution are merged into it.
+
+        Parameters:
+
+        + rollups: VisitRollup queryset (e.g. filtered by product or brand).
+
+        + resolution: VisitRollup.Resolution of the series.
+
+        + start, end: series time range (end excluded).
+    """
+    rows = rollups.filter(resolution__lte=resolution, start__gte=truncate(start, resolution),
+                          start__lt=end) \
+        .annotate(bucket=Trunc('start', resolution.label, tzinfo=timezone.utc)) \
+        .values('bucket').annotate(visits=Sum('count')).order_by('bucket')
+    return [{'start': row['bucket'], 'visits': row['visits']} for row in rows]
+
+def add_series(series_list):
+    """ Adds up visits time series (see get_series), e.g. of several batches
+        of products """
+    totals = Counter()
+    for series in series_list:
+        for bucket in series:
+            totals[bucket['start']] += bucket['visits']
+    return [{'start': start, 'visits': visits} for start, visits in sorted(totals.items())]
@@ -0,0 +1,56 @@
+import sys
+
+from django.db import connections
+from django.template import TemplateDoesNotExist
+from django.template.loader import get_template
+from django.urls import get_resolver, reverse
+
+from catalogsystem.startup import timed
+
+from .replica import catalog_snapshot
+from .serializers import (BrandSerializer, ProductListSerializer, ProductSerializer,
+    ProductSerializerForAnon, UserSerializer)
+
+def warm_up_urls():
+    """ Builds URL resolver and reverse tables """
+    resolver = get_resolver()
+    resolver.resolve('/api/')
+    reverse('api-root')
+    reverse('product-detail', kwargs={'pk': 1}) # Built for the first reverse()
+
+def warm_up_serializers():
+    """ Builds serializer fields (imports lazily loaded field classes and
+        model metadata caches used on the first requests) """
+    for serializer_class in (ProductSerializer, ProductListSerializer, ProductSerializerForAnon,
+                             BrandSerializer, UserSerializer):
+        serializer_class().fields
+
+def warm_up_templates():
+    """ Loads browsable API templates """
+    for template_name in ('rest_framework/api.html', 'rest_framework/login.html'):
+        try:
+            get_template(template_name)
+        except TemplateDoesNotExist:
+            pass
+
+def warm_up_caches():
+    """ Loads the catalog snapshot, if enabled """
+    if catalog_snapshot.enabled:
+        try:
+            catalog_snapshot.load()
+        except Exception as exc: # Not fatal (e.g. database down or misconfigured)
+            print(f"Warning: Could not load catalog snapshot: {exc}", file=sys.stderr)
+
+def warm_up():
+    """ Runs work otherwise done by the first requests of a worker.
+        Safe to run before forking workers (see gunicorn.conf.py): database
+        connections opened to prime caches are closed afterwards. """
+    with timed('warm-up: URLs'):
+        warm_up_urls()
+    with timed('warm-up: serializers'):
+        warm_up_serializers()
+    with timed('warm-up: templates'):
+        warm_up_templates()
+    with timed('warm-up: caches'):
+        warm_up_caches()
+    connections.close_all() # Not shared with forked workers